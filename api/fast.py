@@ -2,28 +2,41 @@
 import os
 import warnings
 import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from io import BytesIO
+from typing import Optional
 from base64 import b64encode, b64decode, urlsafe_b64decode
 
 # Third-party
+import numpy as np
 import pandas as pd
-import cv2
 from PIL import Image, ImageDraw, ImageFont
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
 
 # Local application
 from legolas.segmentation.registry import load_model_RF, load_SAM
-from legolas.classification.main import classify_part
+from legolas.segmentation.sam import (
+    EmbeddingCache,
+    generate_masks,
+    get_embeddings,
+    segment_boxes,
+    segment_prompt
+)
+from legolas.segmentation.filtering import filter_masks
+from legolas.classification.main import classify_parts
+from legolas.classification.cache import ClassificationCache
 from legolas.classification.lego_color_detector import (
     load_lego_colors,
     detect_lego_color
 )
-from legolas.API_rebrickable.main_api import part_colors
+from legolas.API_rebrickable.main_api import parts_colors
 from legolas.API_rebrickable.main import add_parts_to_username_partlist
 from legolas.segmentation.constants import (
     SAM_CONFIG_1,
@@ -32,16 +45,48 @@ from legolas.segmentation.constants import (
     ROBOFLOW_PROJECT_ID_LBD,
     ROBOFLOW_PROJECT_VERSION_LBD
 )
-from legolas.completion.main import (
-    download_csv_files,
-    list_set_contenant_au_moins_une_des_pieces,
-    available_part_num_dict,
-    generate_final_df
-)
+from legolas.completion.catalog import CatalogManager
+from legolas.completion.cache import ResultCache
+from legolas.completion.parallel import ParallelScorer
+from legolas.completion.main import suggest_sets
+from api.jobs import JobStore
 
 load_dotenv(dotenv_path="../.env", override=True)
 
 ROBOFLOW_API_KEY = os.getenv("ROBOFLOW_API_KEY", "")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 3600))
+# largest k accepted by /generate_final_df: colour details are computed for
+# each of the k best sets
+SUGGEST_MAX_K = int(os.getenv("SUGGEST_MAX_K", 50))
+# how long (s) /generate_final_df waits for a first catalog before a 503
+CATALOG_WAIT_TIMEOUT = float(os.getenv("CATALOG_WAIT_TIMEOUT", 30))
+# 0 disables the Brickognize cache (see ClassificationCache)
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", 10000))
+CLASSIFICATION_CACHE_DISTANCE = int(
+    os.getenv("CLASSIFICATION_CACHE_DISTANCE", 6))
+# 0 disables the process pool used to score very large part lists
+SCORING_PROCESSES = int(os.getenv("SCORING_PROCESSES", 0))
+SCORING_PARALLEL_MIN_CANDIDATES = int(
+    os.getenv("SCORING_PARALLEL_MIN_CANDIDATES", 5000))
+PREDICT_BATCH_MAX_IMAGES = int(os.getenv("PREDICT_BATCH_MAX_IMAGES", 16))
+# background jobs: number of jobs run at once (caps SAM load), queue size and
+# how long (s) a finished job result is kept
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 32))
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+# finished jobs kept at most (each holds its annotated images and crops)
+JOB_MAX_FINISHED = int(os.getenv("JOB_MAX_FINISHED", 64))
+# CPU inference of SAM: int8 image encoder, torch threads (0 = torch default)
+# and startup check of int8 masks against fp32 ones (one more encoder run)
+SAM_QUANTIZE = os.getenv("SAM_QUANTIZE", "0") == "1"
+SAM_NUM_THREADS = int(os.getenv("SAM_NUM_THREADS", 0))
+SAM_SELF_CHECK = os.getenv("SAM_SELF_CHECK", "0") == "1"
+# "torch" or "onnx" (CPU only: encoder and decoder run on onnxruntime)
+SAM_BACKEND = os.getenv("SAM_BACKEND", "torch")
+# part detection models accepted by /predict and /predict_batch. LBD+SAM
+# refines the LBD boxes into SAM masks, one box prompt per detected part
+MODELS = ("LOD", "LBD", "SAM", "LBD+SAM")
 
 
 class PostPredictData(BaseModel):
@@ -50,12 +95,56 @@ class PostPredictData(BaseModel):
     model: str
 
 
-app = FastAPI()
+class PostPredictBatchData(BaseModel):
+    """Class for objects used in batch segmentation"""
+    imgs_base64: list[str]
+    model: str
+
+
+class PostSegmentData(BaseModel):
+    """Class for objects used in prompt-based SAM segmentation"""
+    img_base64: str
+    points: Optional[list[list[float]]] = None  # [[x, y], ...]
+    labels: Optional[list[int]] = None  # 1 = part, 0 = background
+    box: Optional[list[float]] = None  # [x0, y0, x1, y1]
+
+
+catalog_manager = CatalogManager()
+# suggestions are memoized per (canonical part list, catalog version, k,
+# tolerant)
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+# Brickognize results per perceptual hash of the crops, on disk: re-uploads
+# of a photo, even re-cropped, do not call Brickognize again
+classification_cache = (ClassificationCache(
+    max_size=CLASSIFICATION_CACHE_SIZE,
+    max_distance=CLASSIFICATION_CACHE_DISTANCE)
+                        if CLASSIFICATION_CACHE_SIZE > 0 else None)
+job_store = JobStore(JOB_WORKERS, JOB_MAX_PENDING, JOB_TTL,
+                     JOB_MAX_FINISHED)
+# SAM image embeddings of the last photos, shared by /predict and /segment
+sam_embeddings = EmbeddingCache()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the Rebrickable catalog is refreshed in the background, never in a request
+    catalog_manager.start()
+    yield
+    catalog_manager.stop()
+    job_store.shutdown()
+    for _, scorer in scorers.values():
+        scorer.close()
+    if classification_cache is not None:
+        classification_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 model_LOD = load_model_RF(ROBOFLOW_API_KEY, ROBOFLOW_PROJECT_ID_LOD,
                           ROBOFLOW_PROJECT_VERSION_LOD)
 model_LBD = load_model_RF(ROBOFLOW_API_KEY, ROBOFLOW_PROJECT_ID_LBD,
                           ROBOFLOW_PROJECT_VERSION_LBD)
-model_SAM = load_SAM()
+model_SAM = load_SAM(SAM_QUANTIZE, SAM_NUM_THREADS, SAM_SELF_CHECK,
+                     SAM_BACKEND)
 
 assert model_LOD is not None
 assert model_LBD is not None
@@ -82,64 +171,95 @@ def root():
 lego_colors = load_lego_colors(
     "./legolas/classification/lego_colors_rebrickable.csv")
 
-# Endpoint for https://your-domain.com/predict?input_one=154&input_two=199
 
+def decode_image(img_base64: str):
+    """Decode an uploaded image once, for every stage of /predict.
+    Returns the raw bytes, the RGB PIL image and its numpy array.
+    """
+    image_bytes = b64decode(img_base64)
+    image = Image.open(BytesIO(image_bytes)).convert("RGB")
+    return image_bytes, image, np.asarray(image)
 
-@app.post("/predict")
-def post_predict(data: PostPredictData):
-    """From an input image:
-    - Resize then segment it (i.e., detect parts)
-    - Crop individual parts
-    - Call Brickognize on each part
-    - Build an HTML table from a df
 
-    Returns:
-      a JSONResponse object containing info from Brickognize (and more?)
+def predict_RF(model, image_bytes: bytes) -> dict:
+    """Run a Roboflow model, which needs an image path: the upload is written
+    to a unique temporary file, removed right after the call.
     """
+    with tempfile.NamedTemporaryFile(suffix=".jpeg") as tmp_file:
+        tmp_file.write(image_bytes)
+        tmp_file.flush()
+        return model.predict(tmp_file.name, confidence=40,
+                             overlap=30).json()
+
 
-    temp_image_path = "/tmp/temp.jpeg"
-    with open(temp_image_path, "wb") as tmp_file:
-        tmp_file.write(b64decode(data.img_base64))
-    image = Image.open(temp_image_path)
-    # image.show()  # debug, display img in another window
-
-    if data.model == "LOD":
-        result = app.state.model_LOD.predict(temp_image_path,
-                                             confidence=40,
-                                             overlap=30).json()
-        preds = result["predictions"]
-
-    elif data.model == "LBD":
-        result = app.state.model_LBD.predict(temp_image_path,
-                                             confidence=40,
-                                             overlap=30).json()
-        preds = result["predictions"]
-
-    elif data.model == "SAM":
-        image_arr = cv2.imread(temp_image_path)
-        image_arr = cv2.cvtColor(image_arr, cv2.COLOR_BGR2RGB)
-        mask_generator = SamAutomaticMaskGenerator(
-            model=model_SAM, **SAM_CONFIG_1)
+def detect_parts(model: str, images: list) -> list:
+    """Detect parts on decoded images (see decode_image) with the given model.
+    Roboflow calls run concurrently, SAM images are encoded in batches and
+    SAM masks are filtered (see filter_masks) so that studs, sub-regions and
+    duplicates of a part are not classified on their own.
+
+    Returns:
+      the predictions of each image
+    """
+    if model == "SAM":
         # masks are renamed "preds" for consistency with RF
-        preds = mask_generator.generate(image_arr)
-    else:
-        warnings.warn(
-            f"data.model must be either 'LOD', 'LBD' or 'SAM', got '{data.model}'"
-        )
-        return JSONResponse(content={
-            "image": None,
-            "results": None
-        },
-            status_code=555)
+        masks = generate_masks(app.state.model_SAM,
+                               [image_arr for _, _, image_arr in images],
+                               SAM_CONFIG_1,
+                               cache=sam_embeddings)
+        return _filter_masks(images, masks)
+
+    if model == "LBD+SAM":
+        preds = detect_parts("LBD", images)
+        # images are encoded in batches once, then each box is a prompt
+        get_embeddings(app.state.model_SAM,
+                       [image_arr for _, _, image_arr in images],
+                       cache=sam_embeddings)
+        masks = [
+            segment_boxes(app.state.model_SAM, image_arr,
+                          [[pred["x"] - pred["width"] / 2,
+                            pred["y"] - pred["height"] / 2,
+                            pred["x"] + pred["width"] / 2,
+                            pred["y"] + pred["height"] / 2]
+                           for pred in image_preds],
+                          cache=sam_embeddings)
+            for (_, _, image_arr), image_preds in zip(images, preds)
+        ]
+        # the detector already rejected implausible parts: no size bounds
+        return _filter_masks(images, masks, check_size=False)
+
+    model_RF = app.state.model_LOD if model == "LOD" else app.state.model_LBD
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        results = executor.map(
+            lambda image: predict_RF(model_RF, image[0]), images)
+        return [result["predictions"] for result in results]
+
+
+def _filter_masks(images: list, masks: list, check_size: bool = True) -> list:
+    """filter_masks on the masks of each image"""
+    filtered = []
+    for (_, _, image_arr), image_masks in zip(images, masks):
+        kept = filter_masks(image_masks, image_arr.shape,
+                            check_size=check_size)
+        print(f"SAM: {len(kept)}/{len(image_masks)} masks kept after filtering")
+        filtered.append(kept)
+    return filtered
+
+
+def crop_parts(model: str, image, preds: list) -> list:
+    """Crop each detected part and draw its numbered bbox on image.
 
-    os.remove(temp_image_path)
+    Returns:
+      the (JPEG buffer, base64) of each crop, in prediction order
+    """
     image_orig = image.copy()
-
     draw = ImageDraw.Draw(image)  # draw bboxes and labels on top of this
-    results = pd.DataFrame()  # store brickognize outputs here
+    font = ImageFont.truetype("resources/Roboto_Condensed-Medium.ttf",
+                              size=24)
+    crops = []
 
     for i, pred in enumerate(preds):
-        if data.model in ["LOD", "LBD"]:
+        if model in ["LOD", "LBD"]:
             # RF models
             x, y = pred["x"], pred["y"]  # coords of the center of the brick
             w, h = pred["width"], pred["height"]
@@ -150,7 +270,7 @@ def post_predict(data: PostPredictData):
             lower = int(y + h / 2)
             # confidence = pred["confidence"]
         else:
-            # SAM
+            # SAM, LBD+SAM
             left, upper, w, h = pred["bbox"]
             right = left + w
             lower = upper + h
@@ -171,14 +291,29 @@ def post_predict(data: PostPredictData):
         jpeg_bytes = buf.getvalue()
         img_base64 = b64encode(jpeg_bytes).decode('utf-8')
 
-        font = ImageFont.truetype("resources/Roboto_Condensed-Medium.ttf",
-                                  size=24)
         draw.rectangle([left, upper, right, lower], outline="black", width=4)
         draw.text((left, upper - 24), f"{i+1}", fill="black", font=font)
+        crops.append((buf, img_base64))
+
+    return crops
+
+
+def _part_colors(_results):
+    if _results.empty:
+        return pd.Series([None, []])
+    print(_results.rebrickable_id[0])
+    print(_results.color_name.to_list())
+    return _results.rebrickable_id[0], _results.color_name.to_list()
 
-        # Envoi à Brickognize
-        df = classify_part(buf)
 
+def describe_parts(crops: list, dfs: list,
+                   rebrickable_parts: dict) -> pd.DataFrame:
+    """Build the results table of one image from the Brickognize results of
+    its crops and the Rebrickable info of each Brickognize id.
+    """
+    results = pd.DataFrame()  # store brickognize outputs here
+
+    for i, ((buf, img_base64), df) in enumerate(zip(crops, dfs)):
         # Traitement des résultats
         if not df.empty:
             expanded = df['external_sites'].apply(
@@ -199,34 +334,250 @@ def post_predict(data: PostPredictData):
 
             df['color'] = df['detected_color']
 
-            def _part_colors(x):
-                _results = part_colors(x)
-                if _results.empty:
-                    return pd.Series([None, []])
-                print(_results.rebrickable_id[0])
-                print(_results.color_name.to_list())
-                return _results.rebrickable_id[0], _results.color_name.to_list()
-
             df[["rebrickable_id", "colors"]] = df['id'].apply(
-                lambda x: pd.Series(_part_colors(x)))
+                lambda x: pd.Series(rebrickable_parts[x]))
 
             # print(df)
 
             results = pd.concat([results, df], ignore_index=True)
 
     # print(results)
+    return results
 
+
+def classify_crops(crops_per_image: list, job=None) -> list:
+    """Classify the crops of one or several images. Brickognize is called
+    once per distinct crop and Rebrickable (or the offline catalog index) once
+    per distinct Brickognize id, across all images, both concurrently. If job
+    is given, the progress of both stages is reported to it.
+
+    Returns:
+      the results table of each image (see describe_parts)
+    """
+    # Envoi à Brickognize : crops distincts en parallèle
+    unique_crops = list(
+        dict.fromkeys(buf.getvalue()
+                      for crops in crops_per_image for buf, _ in crops))
+    def progress(done, total):
+        job.update("classification", done, total)
+
+    if job is not None:
+        progress(0, len(unique_crops))
+    dfs = dict(
+        zip(unique_crops,
+            classify_parts(unique_crops,
+                           progress=progress if job is not None else None,
+                           cache=classification_cache)))
+
+    part_ids = {
+        part_id
+        for df in dfs.values() if not df.empty for part_id in df['id']
+    }
+
+    def enrichment_progress(done, total):
+        job.update("enrichment", done, total)
+
+    # Rebrickable enrichment: distinct ids in parallel, rate-limited. The
+    # catalog resolves most ids offline; it is not waited for on the very
+    # first start, the API answering meanwhile
+    if job is not None:
+        enrichment_progress(0, len(part_ids))
+    catalog = catalog_manager.catalog
+    rebrickable_parts = {
+        part_id: _part_colors(colors)
+        for part_id, colors in parts_colors(
+            part_ids,
+            progress=enrichment_progress if job is not None else None,
+            index=catalog.part_ids if catalog is not None else None).items()
+    }
+
+    return [
+        describe_parts(crops, [dfs[buf.getvalue()] for buf, _ in crops],
+                       rebrickable_parts) for crops in crops_per_image
+    ]
+
+
+def encode_image(image) -> str:
+    """Base64 JPEG of an (annotated) image"""
     buffer = BytesIO()
     image.save(buffer, format="JPEG")
-    img_bytes = buffer.getvalue()
+    return b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def predict_images(model: str, imgs_base64: list, job=None) -> dict:
+    """Detect, crop and classify the parts of several images.
+
+    Returns:
+      for each image and in the same order, the annotated image and its
+      results (as returned by /predict)
+    """
+    images = [decode_image(img_base64) for img_base64 in imgs_base64]
+    if job is not None:
+        job.update("detection", 0, len(images))
+    preds = detect_parts(model, images)
+    if job is not None:
+        job.update("detection", len(images), len(images))
+    crops = [
+        crop_parts(model, image, image_preds)
+        for (_, image, _), image_preds in zip(images, preds)
+    ]
+    results = classify_crops(crops, job)
+
+    return {
+        "images": [{
+            "image": encode_image(image),
+            "results": image_results.to_dict(orient="records")
+        } for (_, image, _), image_results in zip(images, results)]
+    }
+
+
+# Endpoint for https://your-domain.com/predict?input_one=154&input_two=199
+
+
+@app.post("/predict")
+def post_predict(data: PostPredictData):
+    """From an input image:
+    - Resize then segment it (i.e., detect parts)
+    - Crop individual parts
+    - Call Brickognize on each part
+    - Build an HTML table from a df
+
+    Returns:
+      a JSONResponse object containing info from Brickognize (and more?)
+    """
+    if data.model not in MODELS:
+        warnings.warn(
+            f"data.model must be one of {MODELS}, got '{data.model}'"
+        )
+        return JSONResponse(content={
+            "image": None,
+            "results": None
+        },
+            status_code=555)
+
+    image = decode_image(data.img_base64)
+    # image[1].show()  # debug, display img in another window
+    preds = detect_parts(data.model, [image])[0]
+    crops = crop_parts(data.model, image[1], preds)
+    results = classify_crops([crops])[0]
+
+    return JSONResponse(
+        content={
+            "image": encode_image(image[1]),
+            "results": results.to_dict(orient="records")
+        })
+
+
+@app.post("/predict_batch")
+def post_predict_batch(data: PostPredictBatchData):
+    """/predict over several pictures of the same pile, in one call:
+    - detection runs as a batch (SAM images are encoded together)
+    - Brickognize and Rebrickable lookups are shared by all crops
+
+    Returns:
+      a JSONResponse object with, for each image and in the same order, the
+      annotated image and its results (as returned by /predict)
+    """
+    if data.model not in MODELS:
+        warnings.warn(
+            f"data.model must be one of {MODELS}, got '{data.model}'"
+        )
+        return JSONResponse(content={"images": None}, status_code=555)
+    if not 0 < len(data.imgs_base64) <= PREDICT_BATCH_MAX_IMAGES:
+        return JSONResponse(content={
+            "error":
+            f"expected 1 to {PREDICT_BATCH_MAX_IMAGES} images, got {len(data.imgs_base64)}"
+        },
+            status_code=413)
+
+    return JSONResponse(content=predict_images(data.model, data.imgs_base64))
+
+
+@app.get("/predict/cache_stats")
+def get_predict_cache_stats():
+    """Hit rate of the Brickognize cache shared by all predictions"""
+    if classification_cache is None:
+        return JSONResponse(content={"error": "cache disabled"},
+                            status_code=404)
+    return JSONResponse(content=classification_cache.stats())
+
+
+@app.post("/segment")
+def post_segment(data: PostSegmentData):
+    """Segment one more part of a photo from a click (points) or a box, e.g.
+    a part missed by /predict. The SAM embedding of a photo already seen is
+    reused, so only the mask decoder runs.
+
+    Returns:
+      the image annotated with the new crop, its bbox (XYWH) and its results
+      (as returned by /predict)
+    """
+    if not data.points and not data.box:
+        return JSONResponse(content={"error": "expected points or a box"},
+                            status_code=422)
+
+    _, image, image_arr = decode_image(data.img_base64)
+    pred = segment_prompt(app.state.model_SAM, image_arr, data.points,
+                          data.labels, data.box, cache=sam_embeddings)
+    if pred is None:
+        return JSONResponse(content={
+            "image": None,
+            "bbox": None,
+            "results": []
+        })
+
+    crops = crop_parts("SAM", image, [pred])
+    results = classify_crops([crops])[0]
 
     return JSONResponse(
         content={
-            "image": b64encode(img_bytes).decode('utf-8'),
+            "image": encode_image(image),
+            "bbox": pred["bbox"],
             "results": results.to_dict(orient="records")
         })
 
 
+@app.post("/jobs/predict")
+def post_jobs_predict(data: PostPredictBatchData):
+    """Same as /predict_batch, run in the background by the job worker pool
+    (slow models such as SAM on CPU would hit request timeouts otherwise).
+
+    Returns:
+      the job id, to poll with GET /jobs/{job_id}
+    """
+    if data.model not in MODELS:
+        warnings.warn(
+            f"data.model must be one of {MODELS}, got '{data.model}'"
+        )
+        return JSONResponse(content={"job_id": None}, status_code=555)
+    if not 0 < len(data.imgs_base64) <= PREDICT_BATCH_MAX_IMAGES:
+        return JSONResponse(content={
+            "error":
+            f"expected 1 to {PREDICT_BATCH_MAX_IMAGES} images, got {len(data.imgs_base64)}"
+        },
+            status_code=413)
+
+    job = job_store.submit(predict_images, data.model, data.imgs_base64)
+    if job is None:
+        return JSONResponse(content={"error": "too many pending jobs"},
+                            status_code=429)
+    return JSONResponse(content={
+        "job_id": job.id,
+        "status": job.status
+    },
+        status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Status and per-stage progress of a job, with its result once done"""
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": f"unknown job {job_id}"},
+                            status_code=404)
+    return JSONResponse(content=job.to_dict())
+
+
 @app.get("/add_parts_to_username_partlist")
 def get_add_parts_to_username_partlist(user_name, password, part_list_name, base64_json_parts_list):
     json_parts_list = urlsafe_b64decode(
@@ -239,25 +590,82 @@ def get_add_parts_to_username_partlist(user_name, password, part_list_name, base
         })
 
 
+# tolerant flag -> (catalog version, process-pool scorer)
+scorers = {}
+scorer_lock = threading.Lock()
+
+
+def get_scorer(catalog, tolerant=False):
+    """Return the process-pool scorer of the current catalog, if enabled.
+    The pool of a replaced catalog is closed in the background once its tasks
+    are done, so that requests never wait for it.
+    """
+    if SCORING_PROCESSES <= 0:
+        return None
+    previous = None
+    with scorer_lock:
+        version, scorer = scorers.get(tolerant, (None, None))
+        if version != catalog.version:
+            previous = scorer
+            engine = (catalog.tolerant_scoring_engine
+                      if tolerant else catalog.scoring_engine)
+            scorer = ParallelScorer(engine, SCORING_PROCESSES,
+                                    SCORING_PARALLEL_MIN_CANDIDATES)
+            scorers[tolerant] = (catalog.version, scorer)
+    if previous is not None:
+        threading.Thread(target=previous.close,
+                         name="scorer-close",
+                         daemon=True).start()
+    return scorer
+
+
 @app.get("/generate_final_df")
-def get_generate_final_df(base64_json_parts_list):
+def get_generate_final_df(base64_json_parts_list,
+                          k: int = Query(10, ge=1, le=SUGGEST_MAX_K),
+                          tolerant: bool = False):
+    """Suggest the k most buildable sets from a part list.
+    With tolerant=true, mold, print, pattern and alternate variants of a part
+    (Rebrickable part relationships) count as the same part.
+    """
     json_parts_list = urlsafe_b64decode(
         base64_json_parts_list.encode()).decode()
     parts_list = json.loads(json_parts_list)
     print(parts_list)
-    df_inventories, df_inventory_parts, df_sets = download_csv_files()
-    sets_df = list_set_contenant_au_moins_une_des_pieces(
-        parts_list, 5, df_inventories, df_inventory_parts)
-    available_qty, available_qty_no_color = available_part_num_dict(parts_list)
-    df_no_color_final, df_color_final = generate_final_df(
-        sets_df, available_qty, available_qty_no_color, df_sets)
-
-    return JSONResponse(
-        content={
+    catalog = catalog_manager.get(timeout=CATALOG_WAIT_TIMEOUT)
+    if catalog is None:
+        return JSONResponse(content={"error": "catalog not loaded yet"},
+                            status_code=503)
+    key = result_cache.key(parts_list, catalog.version, k=k,
+                           tolerant=tolerant)
+    content = result_cache.get(key)
+    if content is None:
+        if tolerant:
+            df_no_color_final, df_color_final = suggest_sets(
+                catalog.canonical_part_list(parts_list),
+                catalog.tolerant_part_index,
+                catalog.tolerant_scoring_engine,
+                catalog.inventories, catalog.sets, k=k,
+                scorer=get_scorer(catalog, tolerant=True))
+        else:
+            df_no_color_final, df_color_final = suggest_sets(
+                parts_list, catalog.part_index, catalog.scoring_engine,
+                catalog.inventories, catalog.sets, k=k,
+                scorer=get_scorer(catalog))
+        df_no_color_final = catalog.decode_set_nums(df_no_color_final)
+        df_color_final = catalog.decode_set_nums(df_color_final)
+        content = {
             "df_no_color_final":
             df_no_color_final[['inventory_id', 'img_url', 'set_num', 'percent_no_colour']].to_json(
                 orient="records"),
             "df_color_final":
             df_color_final[['inventory_id', 'img_url', 'set_num', 'percent_colour_match'
                             ]].to_json(orient="records")
-        })
+        }
+        result_cache.put(key, content)
+
+    return JSONResponse(content=content)
+
+
+@app.get("/generate_final_df/cache_stats")
+def get_generate_final_df_cache_stats():
+    return JSONResponse(content=result_cache.stats())
@@ -0,0 +1,114 @@
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """State of a submitted job, updated by the worker running it"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued, running, done or failed
+        self.stage = None
+        self.progress = {}  # stage -> {"done": n, "total": n}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def update(self, stage: str, done: int, total: int):
+        """Report the progress of a stage (called by the job function)"""
+        with self._lock:
+            self.stage = stage
+            self.progress[stage] = {"done": done, "total": total}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            content = {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "progress": {
+                    stage: dict(progress)
+                    for stage, progress in self.progress.items()
+                },
+                "error": self.error,
+            }
+            if self.status == "done":
+                content["result"] = self.result
+            return content
+
+
+class JobStore:
+    """In-process job queue run by a bounded pool of worker threads.
+
+    At most `workers` jobs run at once, whatever the number of connections;
+    other jobs wait in the queue (up to `max_pending`). Finished jobs are kept
+    `ttl` seconds so their result can be fetched, then dropped; beyond
+    `max_finished` of them, the oldest are dropped earlier, which bounds the
+    memory held by results.
+    Jobs live in the memory of the API process: with several uvicorn workers,
+    the status must be asked to the process that accepted the job.
+    """
+
+    def __init__(self, workers: int = 1, max_pending: int = 32,
+                 ttl: float = 3600, max_finished: int = 64):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="job")
+
+    def submit(self, fn, *args):
+        """Queue fn(*args, job=job), whose return value becomes the job result.
+        Returns the job, or None if the queue is full.
+        """
+        self._purge()
+        with self._lock:
+            pending = sum(job.status in ("queued", "running")
+                          for job in self._jobs.values())
+            if pending >= self.max_pending:
+                return None
+            job = Job()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, fn, args):
+        with job._lock:
+            job.status = "running"
+        try:
+            result = fn(*args, job=job)
+            status, error = "done", None
+        except Exception as e:
+            traceback.print_exc()
+            result, status, error = None, "failed", str(e)
+        with job._lock:
+            job.result, job.status, job.error = result, status, error
+            job.finished = time.time()
+        self._purge()
+
+    def _purge(self):
+        """Drop the finished jobs older than ttl, then the oldest finished
+        jobs beyond max_finished"""
+        limit = time.time() - self.ttl
+        with self._lock:
+            finished = sorted((job.finished, job_id)
+                              for job_id, job in self._jobs.items()
+                              if job.finished is not None)
+            excess = len(finished) - self.max_finished
+            for i, (finished_at, job_id) in enumerate(finished):
+                if i < excess or finished_at < limit:
+                    del self._jobs[job_id]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
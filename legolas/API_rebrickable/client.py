@@ -0,0 +1,221 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+
+REBRICKABLE_API_KEY = os.getenv("REBRICKABLE_API_KEY")
+REBRICKABLE_API_URL = "https://rebrickable.com/api/v3"
+# débit moyen (appels/s) et rafale maximale des appels réseau à Rebrickable,
+# qui limite les clés d'API à environ un appel par seconde
+REBRICKABLE_RATE = float(os.getenv("REBRICKABLE_RATE", 1))
+REBRICKABLE_BURST = int(os.getenv("REBRICKABLE_BURST", 5))
+# nombre maximal de pièces enrichies simultanément (voir parts_colors), et
+# donc de connexions gardées ouvertes
+REBRICKABLE_CONCURRENCY = int(os.getenv("REBRICKABLE_CONCURRENCY", 4))
+# nouvelles tentatives après un 429, une erreur 5xx ou une erreur réseau
+REBRICKABLE_MAX_RETRIES = int(os.getenv("REBRICKABLE_MAX_RETRIES", 4))
+# délais (en secondes) de connexion et de lecture de chaque appel
+REBRICKABLE_TIMEOUT = (float(os.getenv("REBRICKABLE_CONNECT_TIMEOUT", 5)),
+                       float(os.getenv("REBRICKABLE_READ_TIMEOUT", 30)))
+
+# seules ces méthodes sont rejouées après une erreur 5xx ou réseau : un POST
+# a pu être traité par le serveur
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+
+
+class TokenBucket:
+    '''
+    Limiteur de débit partagé entre threads : au plus `burst` appels
+    d'affilée, puis `rate` appels par seconde en moyenne.
+    '''
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        '''Attend qu'un appel soit permis, puis le décompte'''
+        with self._lock:
+            self._refill()
+            # le jeton manquant est réservé : les appelants suivants attendent
+            # chacun leur tour
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        '''Aucun nouvel appel avant seconds secondes (après un 429)'''
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+def _retry_after(response) -> float:
+    '''Délai demandé par l'en-tête Retry-After (secondes ou date HTTP)'''
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RebrickableClient:
+    """
+    Client unique de l'API Rebrickable, partagé par les fonctions de main_api.
+
+    - les connexions HTTPS sont réutilisées (une session, un pool de
+      connexions par hôte) ;
+    - chaque appel réseau attend un jeton du limiteur de débit, commun à tous
+      les threads ;
+    - un 429 suspend tous les appels pendant le délai Retry-After (ou un
+      délai exponentiel), puis l'appel est rejoué ; les erreurs 5xx et réseau
+      sont rejouées de même pour les méthodes idempotentes, au plus
+      max_retries fois ;
+    - avec cached=True, un GET est d'abord cherché dans le cache disque de
+      requests_cache, sans consommer de jeton.
+
+    Les méthodes a* sont les équivalents asynchrones, exécutés dans un thread
+    pour ne pas bloquer la boucle d'événements.
+    """
+
+    def __init__(self,
+                 api_key=REBRICKABLE_API_KEY,
+                 rate=REBRICKABLE_RATE,
+                 burst=REBRICKABLE_BURST,
+                 max_retries=REBRICKABLE_MAX_RETRIES,
+                 timeout=REBRICKABLE_TIMEOUT,
+                 pool_size=REBRICKABLE_CONCURRENCY,
+                 cache_name="cache",
+                 expire_after=3600):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        self.cached_session = requests_cache.CachedSession(
+            cache_name, expire_after=expire_after)
+        for session in (self.session, self.cached_session):
+            session.mount(
+                "https://",
+                HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            session.headers["Accept"] = "application/json"
+            session.headers["Authorization"] = f"key {api_key}"
+
+    def request(self, method, url, cached=False, **kwargs):
+        """
+        Appel à l'API Rebrickable.
+
+        Args:
+            method (str): Méthode HTTP.
+            url (str): URL complète, ou chemin relatif à REBRICKABLE_API_URL
+                (ex: "/lego/parts/").
+            cached (bool): Pour un GET, utiliser le cache disque.
+            **kwargs: Arguments de requests (params, json, data, headers...).
+
+        Returns:
+            requests.Response: La dernière réponse obtenue, éventuellement en
+                erreur si les tentatives sont épuisées.
+
+        Raises:
+            requests.exceptions.RequestException: Si la dernière tentative
+                échoue sans réponse.
+        """
+        method = method.upper()
+        if not url.startswith("http"):
+            url = f"{REBRICKABLE_API_URL}{url}"
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.cached_session if cached else self.session
+
+        if cached:
+            response = session.request(method,
+                                       url,
+                                       only_if_cached=True,
+                                       **kwargs)
+            if response.status_code != 504:  # présente dans le cache
+                return response
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            self.limiter.acquire()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if last_attempt or method not in IDEMPOTENT_METHODS:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            if response.status_code == 429:
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                # tous les threads attendent : ils seraient aussi refusés
+                self.limiter.pause(delay)
+            elif response.status_code < 500 or \
+                    method not in IDEMPOTENT_METHODS:
+                return response
+            if last_attempt:
+                return response
+            print(f"Rebrickable {response.status_code}, nouvel essai "
+                  f"({attempt + 1}/{self.max_retries})")
+            if response.status_code != 429:
+                time.sleep(self._backoff(attempt))
+        return response
+
+    @staticmethod
+    def _backoff(attempt):
+        '''Délai exponentiel (1, 2, 4... s, au plus 30 s) avec gigue'''
+        return min(2**attempt, 30) * random.uniform(0.5, 1)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    async def arequest(self, method, url, **kwargs):
+        return await asyncio.to_thread(self.request, method, url, **kwargs)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest("GET", url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest("POST", url, **kwargs)
+
+    async def aput(self, url, **kwargs):
+        return await self.arequest("PUT", url, **kwargs)
+
+    async def adelete(self, url, **kwargs):
+        return await self.arequest("DELETE", url, **kwargs)
+
+
+client = RebrickableClient()
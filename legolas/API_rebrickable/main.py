@@ -1,17 +1,22 @@
-from .main_api import get_user_token, add_parts_to_partlist, get_or_create_partlist, delete_partlist
+from .main_api import add_parts_to_partlist
+from .session import get_session, forget_session
 
 
 def add_parts_to_username_partlist(user_name, password, part_list_name,
                                    parts_list):
-    user_token = get_user_token(user_name, password)
+    # token et Part Lists de l'utilisateur sont réutilisés d'un appel à l'autre
+    session = get_session(user_name, password)
 
-    if user_token:
-        id_list = get_or_create_partlist(user_token,
-                                         part_list_name,
-                                         list_type=1)
+    if session:
+        id_list = session.get_or_create_partlist(part_list_name, list_type=1)
 
         if id_list:
-            add_parts_to_partlist(user_token, id_list, parts_list)
+            if not add_parts_to_partlist(session.user_token, id_list,
+                                         parts_list):
+                # liste supprimée ou token révoqué entre-temps : ils seront
+                # relus au prochain appel
+                session.invalidate_partlists()
+                forget_session(user_name, password)
             return f"https://rebrickable.com/users/{user_name}/partlists/{id_list}/"
 
     return "Error Rebrickable"
@@ -41,13 +46,13 @@ if __name__ == "__main__":
     print(result)
 
     # ✅ Ajout de la question pour supprimer la liste
-    user_token = get_user_token(user_name, password)
-    id_list = get_or_create_partlist(user_token, part_list_name, list_type=1)
+    session = get_session(user_name, password)
+    id_list = session.get_or_create_partlist(part_list_name, list_type=1)
 
     user_choice = input(
         f"🔴 Voulez-vous supprimer la liste '{part_list_name}' ? (Y/N) : "
     ).strip().lower()
     if user_choice in ["y", "yes", "o", "oui"]:
-        delete_partlist(user_token, id_list)
+        session.delete_partlist(id_list)
     else:
         print("La liste est conservée.")
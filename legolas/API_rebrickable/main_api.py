@@ -1,34 +1,46 @@
 import requests
-import requests_cache
 import csv
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import HTTPError
 import pandas as pd
 
-REBRICKABLE_API_KEY = os.getenv("REBRICKABLE_API_KEY")
+from .client import REBRICKABLE_CONCURRENCY, client
 
-cached_session = requests_cache.CachedSession('cache', expire_after=3600)
+# nombre maximal de pièces par appel d'ajout groupé à une Part List, et de
+# pièces par page lors de sa lecture
+PARTLIST_CHUNK_SIZE = 100
+PARTLIST_PAGE_SIZE = 1000
 
 
-def get_rebrickable_id(bricklink_id):
+def get_rebrickable_id(bricklink_id, index=None):
     """
-    Récupère l'ID Rebrickable associé à un ID BrickLink via l'API.
+    Récupère l'ID Rebrickable associé à un ID BrickLink, via l'index hors
+    ligne s'il le connaît, sinon via l'API.
 
     Args:
         bricklink_id (str): L'identifiant BrickLink de la pièce.
+        index (PartIdIndex): Index du catalogue (cf. Catalog.part_ids), qui
+            apprend les réponses de l'API.
 
     Returns:
         str: L'identifiant Rebrickable correspondant, ou None si non trouvé.
     """
-    HEADERS = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
-    url = "https://rebrickable.com/api/v3/lego/parts/"
+    if index is not None:
+        rebrickable_id = index.rebrickable_id(bricklink_id)
+        if rebrickable_id is not None:
+            return rebrickable_id
 
     params = {"bricklink_id": bricklink_id}
-    response = cached_session.get(url, headers=HEADERS, params=params)
+    response = client.get("/lego/parts/", params=params, cached=True)
     response.raise_for_status()
     data = response.json()
     results = data.get("results", [])
-    return results[0]["part_num"] if results else None
+    rebrickable_id = results[0]["part_num"] if results else None
+    if index is not None:
+        index.learn(bricklink_id, rebrickable_id)
+    return rebrickable_id
 
 
 def export_bricklink_to_rebrickable_csv(bricklink_ids,
@@ -138,17 +150,9 @@ def get_user_token(user_name, password):
     - La variable globale `REBRICKABLE_API_KEY` doit être définie avant l'appel de cette fonction.
     - Ce token peut être utilisé ensuite pour authentifier des requêtes spécifiques à l'utilisateur (sets, lists, etc.).
     """
-    URL = "https://rebrickable.com/api/v3/users/_token/"
-
     data = {'username': user_name, 'password': password}
 
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Accept': 'application/json',
-        'Authorization': f'key {REBRICKABLE_API_KEY}'
-    }
-
-    response = requests.post(URL, data=data, headers=headers)
+    response = client.post("/users/_token/", data=data)
 
     if response.status_code == 200:
         user_token = response.json().get('user_token')
@@ -166,12 +170,10 @@ def create_partlist(user_token, name_new_list, list_type=1):
 
     Retourne : JSON avec le détail de la liste créée.
     """
-    url = f"https://rebrickable.com/api/v3/users/{user_token}/partlists/"
-    headers = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
     payload = {"name": name_new_list, "type": list_type}
 
     try:
-        resp = requests.post(url, headers=headers, json=payload)
+        resp = client.post(f"/users/{user_token}/partlists/", json=payload)
         resp.raise_for_status()
         data = resp.json()
         return data
@@ -205,17 +207,22 @@ def get_id_list(name_new_list, user_token):
 
 
 def delete_partlist(user_token, id_list):
-    url = f"https://rebrickable.com/api/v3/users/{user_token}/partlists/{id_list}/"
-    headers = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
+    """
+    Supprime une Part List.
 
-    response = requests.delete(url, headers=headers)
+    Returns:
+        bool: True si la liste a été supprimée, False sinon.
+    """
+    response = client.delete(f"/users/{user_token}/partlists/{id_list}/")
 
     if response.status_code == 204:
         print("")
+        return True
     else:
         print(
             f"❌ Erreur {response.status_code} lors de la suppression : {response.text}"
         )
+        return False
 
 
 def csv_to_json_parts(csv_file):
@@ -261,10 +268,46 @@ def csv_to_json_parts(csv_file):
     return parts_list
 
 
+def get_partlist_parts(user_token, id_list):
+    """
+    Récupère toutes les pièces d'une Part List, page par page.
+
+    Args:
+        user_token (str): Le token utilisateur Rebrickable.
+        id_list (int): L'ID de la Part List.
+
+    Returns:
+        dict[tuple[str, int], int]: La quantité de chaque (part_num, color_id).
+
+    Raises:
+        requests.exceptions.HTTPError: Si une requête à l'API échoue.
+    """
+    url = f"/users/{user_token}/partlists/{id_list}/parts/"
+    params = {"page_size": PARTLIST_PAGE_SIZE}
+
+    quantities = {}
+    while url:
+        response = client.get(url, params=params)
+        response.raise_for_status()
+        result = response.json()
+        for item in result.get("results", []):
+            quantities[(item['part']['part_num'],
+                        item['color']['id'])] = item["quantity"]
+        # l'URL de la page suivante contient déjà les paramètres
+        url, params = result.get("next"), None
+    return quantities
+
+
 def add_parts_to_partlist(user_token, id_list, parts_list):
     """
     Ajoute ou met à jour plusieurs parts dans une Part List sur Rebrickable.
 
+    La liste existante est lue en entier (cf. get_partlist_parts) et comparée
+    localement : les pièces nouvelles sont ajoutées par appels groupés de
+    PARTLIST_CHUNK_SIZE pièces, seules les pièces déjà présentes voient leur
+    quantité mise à jour une par une. Les lignes d'une même pièce dans
+    parts_list sont cumulées.
+
     Args:
         user_token (str): Le token utilisateur Rebrickable.
         id_list (int): L'ID de la Part List où ajouter les parts.
@@ -273,42 +316,40 @@ def add_parts_to_partlist(user_token, id_list, parts_list):
     Returns:
         bool: True si l'opération réussit, False sinon.
     """
-    url_base = f"https://rebrickable.com/api/v3/users/{user_token}/partlists/{id_list}/parts/"
-    headers = {
-        "Authorization": f"key {REBRICKABLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    url_base = f"/users/{user_token}/partlists/{id_list}/parts/"
+
+    quantities = {}
+    for part in parts_list:
+        key = (str(part['part_num']), int(part['color_id']))
+        quantities[key] = quantities.get(key, 0) + int(part["quantity"])
 
     try:
         # Récupérer les pièces existantes dans la partlist
-        response = requests.get(url_base, headers=headers)
-        response.raise_for_status()
-        existing_parts = {
-            f"{item['part']['part_num']}-{item['color']['id']}":
-            item["quantity"]
-            for item in response.json().get("results", [])
-        }
-
-        for part in parts_list:
-            part_key = f"{part['part_num']}-{part['color_id']}"
-            quantity = part["quantity"]
-
-            if part_key in existing_parts:
-                # Met à jour la quantité avec Put
-                updated_quantity = existing_parts[part_key] + quantity
-                update_url = f"{url_base}{part['part_num']}/{part['color_id']}/"
-                put_data = {"quantity": updated_quantity}
-                put_response = requests.put(update_url,
-                                            headers=headers,
-                                            json=put_data)
-                put_response.raise_for_status()
-
-            else:
-                # Ajoute la pièce avec POST
-                post_response = requests.post(url_base,
-                                              headers=headers,
-                                              json=part)
-                post_response.raise_for_status()
+        existing_parts = get_partlist_parts(user_token, id_list)
+
+        new_parts = [{
+            "part_num": part_num,
+            "color_id": color_id,
+            "quantity": quantity
+        } for (part_num, color_id), quantity in quantities.items()
+                     if (part_num, color_id) not in existing_parts]
+
+        # Ajoute les nouvelles pièces avec POST, par paquets
+        for start in range(0, len(new_parts), PARTLIST_CHUNK_SIZE):
+            post_response = client.post(
+                url_base, json=new_parts[start:start + PARTLIST_CHUNK_SIZE])
+            post_response.raise_for_status()
+
+        # Met à jour la quantité des pièces existantes avec PUT
+        for (part_num, color_id), quantity in quantities.items():
+            if (part_num, color_id) not in existing_parts or quantity == 0:
+                continue
+            put_data = {
+                "quantity": existing_parts[(part_num, color_id)] + quantity
+            }
+            put_response = client.put(f"{url_base}{part_num}/{color_id}/",
+                                      json=put_data)
+            put_response.raise_for_status()
 
         return True
 
@@ -317,6 +358,33 @@ def add_parts_to_partlist(user_token, id_list, parts_list):
         return False
 
 
+def get_partlists(user_token):
+    """
+    Récupère toutes les Part Lists de l'utilisateur, page par page.
+
+    Args:
+        user_token (str): Token utilisateur pour l'authentification.
+
+    Returns:
+        dict[str, int]: L'ID de chaque Part List, par nom en minuscules.
+
+    Raises:
+        requests.exceptions.HTTPError: Si une requête à l'API échoue.
+    """
+    url = f"/users/{user_token}/partlists/"
+    params = {"page_size": PARTLIST_PAGE_SIZE}
+
+    partlists = {}
+    while url:
+        response = client.get(url, params=params)
+        response.raise_for_status()
+        result = response.json()
+        for item in result["results"]:
+            partlists.setdefault(item["name"].lower(), item["id"])
+        url, params = result.get("next"), None
+    return partlists
+
+
 def get_or_create_partlist(user_token, part_list_name, list_type=1):
     """
     Vérifie si une Part List existe déjà. Si oui, retourne son ID.
@@ -330,24 +398,16 @@ def get_or_create_partlist(user_token, part_list_name, list_type=1):
     Returns:
         int | None: ID de la Part List existante ou nouvellement créée, None en cas d'erreur.
     """
-    url_get = f"https://rebrickable.com/api/v3/users/{user_token}/partlists/"
-    headers = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
-
     try:
-        # Vérifie si une liste avec le même nom existe
-        response = requests.get(url_get, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-
-        for item in data["results"]:
-            if item["name"].lower() == part_list_name.lower(
-            ):  # Ignore la casse
-                return item["id"]
+        # Vérifie si une liste avec le même nom existe (la casse est ignorée)
+        id_list = get_partlists(user_token).get(part_list_name.lower())
+        if id_list is not None:
+            return id_list
 
         # Si la liste n'existe pas, la créer
-        url_post = url_get
         payload = {"name": part_list_name, "type": list_type}
-        response = requests.post(url_post, headers=headers, json=payload)
+        response = client.post(f"/users/{user_token}/partlists/",
+                               json=payload)
         response.raise_for_status()
         new_list = response.json()
 
@@ -370,10 +430,7 @@ def can_build_set(user_token, set_num):
     Returns:
         dict: Détails de la construction possible (pièces manquantes, % de complétion, etc.)
     """
-    url = f"https://rebrickable.com/api/v3/users/{user_token}/build/{set_num}/"
-    headers = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
-
-    response = requests.get(url, headers=headers)
+    response = client.get(f"/users/{user_token}/build/{set_num}/")
     response.raise_for_status()  # Lève une erreur si la requête échoue
     return response.json()
 
@@ -414,12 +471,11 @@ def part_set(set_num):
 
     ATTENTION piece de rechange et minifig non incluse.
     """
-    url = f"https://rebrickable.com/api/v3/lego/sets/{set_num}/parts/"
-    headers = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
+    url = f"/lego/sets/{set_num}/parts/"
 
     rows = []
     while url:
-        response = cached_session.get(url, headers=headers)
+        response = client.get(url, cached=True)
         response.raise_for_status()  # Lève une erreur si la requête échoue
         result = response.json()
 
@@ -444,26 +500,34 @@ def part_set(set_num):
     return df
 
 
-def part_colors(bricklink_id):
+def part_colors(bricklink_id, index=None):
     """
     Récupère toutes les couleurs disponibles pour une pièce LEGO, à partir de son ID BrickLink.
 
     Args:
         bricklink_id (str): L'identifiant BrickLink.
+        index (PartIdIndex): Si fourni, l'ID et les couleurs sont lus dans
+            l'index hors ligne du catalogue, l'API n'étant appelée que pour
+            les pièces qu'il ne connaît pas (part_img_url est alors absent).
 
     Returns:
         pandas.DataFrame: Un DataFrame contenant les détails des couleurs disponibles pour cette pièce.
     """
 
-    HEADERS = {"Authorization": f"key {REBRICKABLE_API_KEY}"}
-    rebrickable_id = get_rebrickable_id(bricklink_id)
+    rebrickable_id = get_rebrickable_id(bricklink_id, index)
 
     if not rebrickable_id:
         print(f" Aucun ID Rebrickable trouvé pour {bricklink_id}.")
         return pd.DataFrame()  # Retourne un DataFrame vide si aucun ID Rebrickable n'est trouvé
 
-    url = f"https://rebrickable.com/api/v3/lego/parts/{rebrickable_id}/colors/"
-    response = cached_session.get(url, headers=HEADERS)
+    if index is not None:
+        df = index.colors(rebrickable_id)
+        if not df.empty:
+            df.insert(0, "bricklink_id", bricklink_id)
+            return df
+
+    response = client.get(f"/lego/parts/{rebrickable_id}/colors/",
+                          cached=True)
     response.raise_for_status()
     data = response.json()
 
@@ -486,3 +550,47 @@ def part_colors(bricklink_id):
     df = pd.DataFrame(rows)
 
     return df
+
+
+def parts_colors(bricklink_ids,
+                 max_workers=REBRICKABLE_CONCURRENCY,
+                 progress=None,
+                 index=None):
+    """
+    part_colors de plusieurs pièces : chaque ID BrickLink distinct est résolu
+    une seule fois, en parallèle (au plus max_workers pièces à la fois), les
+    appels réseau restant limités par le client.
+
+    Args:
+        bricklink_ids (iterable[str]): Les identifiants BrickLink, éventuellement répétés.
+        max_workers (int): Nombre maximal de pièces traitées simultanément.
+        progress (callable): Appelée avec (nombre de pièces traitées, nombre
+            de pièces distinctes) après chaque pièce.
+        index (PartIdIndex): Index hors ligne du catalogue (cf. part_colors).
+
+    Returns:
+        dict[str, pandas.DataFrame]: Le résultat de part_colors de chaque ID
+            distinct, un DataFrame vide si la pièce n'a pu être résolue.
+    """
+    unique_ids = list(dict.fromkeys(bricklink_ids))
+    if not unique_ids:
+        return {}
+    done = 0
+    lock = threading.Lock()
+
+    def _part_colors(bricklink_id):
+        nonlocal done
+        try:
+            df = part_colors(bricklink_id, index)
+        except requests.exceptions.RequestException as err:
+            print(f"❌ Erreur Rebrickable pour {bricklink_id} : {err}")
+            df = pd.DataFrame()
+        if progress is not None:
+            with lock:
+                done += 1
+                progress(done, len(unique_ids))
+        return df
+
+    with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(unique_ids))) as executor:
+        return dict(zip(unique_ids, executor.map(_part_colors, unique_ids)))
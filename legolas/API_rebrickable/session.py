@@ -0,0 +1,155 @@
+import os
+import hmac
+import time
+import hashlib
+import secrets
+import threading
+
+import requests
+
+from .main_api import (get_user_token, get_partlists, create_partlist,
+                       delete_partlist)
+
+# durée de vie (en secondes) d'un token utilisateur mis en cache
+REBRICKABLE_TOKEN_TTL = int(os.getenv("REBRICKABLE_TOKEN_TTL", 3600))
+
+# clé propre au processus : les identifiants ne sont connus que par leur HMAC,
+# qui ne permet pas de les retrouver, même hors du processus
+_CREDENTIALS_KEY = secrets.token_bytes(32)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _credentials_hash(user_name, password):
+    '''HMAC-SHA256 des identifiants, clé du cache des sessions'''
+    return hmac.new(_CREDENTIALS_KEY,
+                    f"{user_name}\0{password}".encode(),
+                    hashlib.sha256).hexdigest()
+
+
+class AuthenticatedSession:
+    """
+    Token d'un utilisateur Rebrickable et IDs de ses Part Lists, réutilisés
+    d'un enregistrement à l'autre (cf. get_session).
+
+    La correspondance nom -> ID des Part Lists est lue une fois, puis tenue à
+    jour par create_partlist et delete_partlist. Le mot de passe n'est pas
+    conservé.
+    """
+
+    def __init__(self, user_name, user_token, ttl=REBRICKABLE_TOKEN_TTL):
+        self.user_name = user_name
+        self.user_token = user_token
+        self.expires = time.monotonic() + ttl
+        self._partlists = None
+        self._lock = threading.Lock()
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def partlists(self):
+        """
+        Returns:
+            dict[str, int]: L'ID de chaque Part List, par nom en minuscules.
+
+        Raises:
+            requests.exceptions.HTTPError: Si une requête à l'API échoue.
+        """
+        with self._lock:
+            if self._partlists is None:
+                self._partlists = get_partlists(self.user_token)
+            return dict(self._partlists)
+
+    def get_or_create_partlist(self, part_list_name, list_type=1):
+        """
+        ID de la Part List de ce nom (la casse est ignorée), créée si besoin.
+
+        Returns:
+            int | None: ID de la Part List, None en cas d'erreur.
+        """
+        try:
+            id_list = self.partlists().get(part_list_name.lower())
+        except requests.exceptions.RequestException as err:
+            print(f"Erreur lors de la requête : {err}")
+            return None
+        if id_list is not None:
+            return id_list
+        return self.create_partlist(part_list_name, list_type)
+
+    def create_partlist(self, part_list_name, list_type=1):
+        """
+        Crée une Part List et l'ajoute aux listes connues.
+
+        Returns:
+            int | None: ID de la Part List créée, None en cas d'erreur.
+        """
+        data = create_partlist(self.user_token, part_list_name, list_type)
+        if data is None:
+            self.invalidate_partlists()
+            return None
+        with self._lock:
+            if self._partlists is not None:
+                self._partlists[part_list_name.lower()] = data['id']
+        return data['id']
+
+    def delete_partlist(self, id_list):
+        """
+        Supprime une Part List et la retire des listes connues.
+
+        Returns:
+            bool: True si la liste a été supprimée, False sinon.
+        """
+        deleted = delete_partlist(self.user_token, id_list)
+        with self._lock:
+            if self._partlists is not None:
+                self._partlists = {
+                    name: other_id
+                    for name, other_id in self._partlists.items()
+                    if other_id != id_list
+                }
+        return deleted
+
+    def invalidate_partlists(self):
+        '''Les Part Lists seront relues au prochain accès (modifiées ailleurs)'''
+        with self._lock:
+            self._partlists = None
+
+
+def get_session(user_name, password):
+    """
+    Session authentifiée d'un utilisateur : celle en cache si son token n'a
+    pas expiré, sinon une nouvelle, obtenue par get_user_token.
+
+    Args:
+        user_name (str): Nom d'utilisateur Rebrickable.
+        password (str): Mot de passe associé au compte Rebrickable.
+
+    Returns:
+        AuthenticatedSession | None: La session, ou None si l'authentification échoue.
+    """
+    key = _credentials_hash(user_name, password)
+    with _sessions_lock:
+        for other_key in [
+                other_key for other_key, session in _sessions.items()
+                if session.expired
+        ]:
+            del _sessions[other_key]
+        session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    user_token = get_user_token(user_name, password)
+    if not user_token:
+        return None
+    session = AuthenticatedSession(user_name, user_token)
+    with _sessions_lock:
+        _sessions[key] = session
+    return session
+
+
+def forget_session(user_name, password):
+    '''Oublie la session d'un utilisateur (token révoqué, par exemple)'''
+    with _sessions_lock:
+        _sessions.pop(_credentials_hash(user_name, password), None)
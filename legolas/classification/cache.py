@@ -0,0 +1,174 @@
+import os
+import time
+import json
+import sqlite3
+import threading
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+CLASSIFICATION_CACHE_PATH = os.getenv(
+    "LEGOLAS_CLASSIFICATION_CACHE", "/tmp/legolas_classification_cache.sqlite")
+# taille du dHash : HASH_SIZE x HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def perceptual_hash(img_data):
+    """
+    dHash d'une image : signe des gradients horizontaux de l'image en niveaux
+    de gris réduite à (HASH_SIZE + 1) x HASH_SIZE pixels. Il est peu sensible
+    à la compression, à un léger recadrage ou à un changement d'échelle.
+
+    Args:
+        img_data (bytes | BytesIO): Image JPEG.
+
+    Returns:
+        tuple[int, float]: Le hash (entier de HASH_SIZE² bits) et le rapport
+            largeur / hauteur de l'image, que le hash ne conserve pas.
+    """
+    if isinstance(img_data, bytes):
+        img_data = BytesIO(img_data)
+    image = Image.open(img_data).convert("L")
+    width, height = image.size
+    pixels = np.asarray(
+        image.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS),
+        dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0]), width / max(height, 1)
+
+
+def _to_signed(value):
+    """Entier non signé 64 bits -> entier signé (type INTEGER de SQLite)"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class ClassificationCache:
+    """
+    Cache disque des résultats Brickognize, indexé par le hash perceptuel des
+    images : une image déjà classée, ou une version légèrement recadrée ou
+    recompressée, est retrouvée sans appel réseau.
+
+    Deux images correspondent si leurs hash diffèrent d'au plus max_distance
+    bits et leurs rapports largeur / hauteur d'au plus aspect_tolerance
+    (relatif). Les entrées sont stockées dans une base SQLite bornée à
+    max_size entrées, les moins récemment utilisées étant évincées. Les hash
+    sont gardés en mémoire : une recherche est un XOR vectorisé sur toutes les
+    entrées. Plusieurs processus peuvent partager la base ; chacun ne voit
+    toutefois que les entrées présentes à son démarrage et les siennes.
+    """
+
+    def __init__(self,
+                 path: str = CLASSIFICATION_CACHE_PATH,
+                 max_size: int = 10000,
+                 max_distance: int = 6,
+                 aspect_tolerance: float = 0.1):
+        self.path = path
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.aspect_tolerance = aspect_tolerance
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                id INTEGER PRIMARY KEY,
+                                hash INTEGER NOT NULL,
+                                aspect REAL NOT NULL,
+                                result TEXT NOT NULL,
+                                used REAL NOT NULL)""")
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT id, hash, aspect FROM entries").fetchall()
+        self._ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self._hashes = np.array([row[1] for row in rows],
+                                dtype=np.int64).view(np.uint64)
+        self._aspects = np.array([row[2] for row in rows], dtype=np.float64)
+
+    def _find(self, hash_value, aspect):
+        """Identifiant de l'entrée la plus proche de (hash_value, aspect), ou
+        None si aucune n'est assez proche"""
+        if not len(self._ids):
+            return None
+        xor = self._hashes ^ np.uint64(hash_value)
+        distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8),
+                                  axis=1).sum(axis=1)
+        distances[np.abs(self._aspects / aspect - 1) >
+                  self.aspect_tolerance] = HASH_SIZE * HASH_SIZE + 1
+        best = int(np.argmin(distances))
+        if distances[best] > self.max_distance:
+            return None
+        return int(self._ids[best])
+
+    def get(self, img_data):
+        """
+        Résultat Brickognize d'une image proche de img_data.
+
+        Returns:
+            pd.DataFrame | None: Le résultat mis en cache, ou None.
+        """
+        hash_value, aspect = perceptual_hash(img_data)
+        with self._lock:
+            entry_id = self._find(hash_value, aspect)
+            if entry_id is None:
+                self.misses += 1
+                return None
+            row = self._db.execute("SELECT result FROM entries WHERE id = ?",
+                                   (entry_id, )).fetchone()
+            if row is None:  # évincée par un autre processus
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE entries SET used = ? WHERE id = ?",
+                             (time.time(), entry_id))
+            self._db.commit()
+            self.hits += 1
+        return pd.DataFrame(json.loads(row[0]))
+
+    def put(self, img_data, df):
+        """Met en cache le résultat Brickognize df de img_data (les résultats
+        vides, c'est-à-dire les échecs, ne le sont pas)"""
+        if df.empty:
+            return
+        hash_value, aspect = perceptual_hash(img_data)
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO entries (hash, aspect, result, used) "
+                "VALUES (?, ?, ?, ?)",
+                (_to_signed(hash_value), aspect, df.to_json(orient="records"),
+                 time.time()))
+            self._ids = np.append(self._ids, cursor.lastrowid)
+            self._hashes = np.append(self._hashes, np.uint64(hash_value))
+            self._aspects = np.append(self._aspects, aspect)
+            if len(self._ids) > self.max_size:
+                self._evict(len(self._ids) - self.max_size)
+            self._db.commit()
+
+    def _evict(self, count):
+        """Supprime les count entrées les moins récemment utilisées"""
+        evicted = [
+            row[0] for row in self._db.execute(
+                "SELECT id FROM entries ORDER BY used LIMIT ?", (count, ))
+        ]
+        self._db.executemany("DELETE FROM entries WHERE id = ?",
+                             [(entry_id, ) for entry_id in evicted])
+        keep = ~np.isin(self._ids, evicted)
+        self._ids = self._ids[keep]
+        self._hashes = self._hashes[keep]
+        self._aspects = self._aspects[keep]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._ids),
+                'max_size': self.max_size,
+                'max_distance': self.max_distance,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,13 +1,40 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+
+BRICKOGNIZE_URL = "https://api.brickognize.com/predict/"
+# nombre maximal d'appels simultanés à Brickognize
+BRICKOGNIZE_CONCURRENCY = int(os.getenv("BRICKOGNIZE_CONCURRENCY", 8))
+# délais (en secondes) de connexion et de lecture de chaque appel
+BRICKOGNIZE_TIMEOUT = (float(os.getenv("BRICKOGNIZE_CONNECT_TIMEOUT", 5)),
+                       float(os.getenv("BRICKOGNIZE_READ_TIMEOUT", 30)))
+
+
+def _make_session():
+    """Session HTTP dont les connexions keep-alive sont réutilisées d'un appel
+    à l'autre, avec au moins une connexion par appel simultané."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=BRICKOGNIZE_CONCURRENCY)
+    session.mount("https://", adapter)
+    session.headers['accept'] = 'application/json'
+    return session
+
+
+session = _make_session()
 
 
-def classify_part(img_data):
+def classify_part(img_data, timeout=BRICKOGNIZE_TIMEOUT):
     """
     Analyse une image LEGO via l'API Brickognize et retourne un DataFrame contenant les résultats.
 
     Args:
-        image_path (str): Chemin d'accès à l'image à analyser.
+        img_data (bytes | BytesIO): Image JPEG à analyser.
+        timeout (tuple): Délais de connexion et de lecture de l'appel, en secondes.
 
     Returns:
         pd.DataFrame: Tableau contenant les informations des pièces LEGO détectées, incluant :
@@ -17,29 +44,25 @@ def classify_part(img_data):
             - category (str) : Catégorie de la pièce LEGO
             - external_site_name (str) : Nom du site externe lié à la pièce
             - external_site_url (str) : URL du site externe
-
-    Raises:
-        ValueError: Si la requête à l'API échoue ou si aucune pièce LEGO n'est détectée.
+        Un DataFrame vide si l'appel échoue ou dépasse le délai.
 
     Example:
-        >>> df = classification("/path/to/image.jpeg")
+        >>> df = classify_part(jpeg_bytes)
         >>> print(df.head())
     """
 
     # with open(image_path, "rb") as img_file:
     #     img_data = img_file.read()
 
-    url = "https://api.brickognize.com/predict/"
-
     files = {
         'query_image': ('image.jpg', img_data, 'image/jpeg')
     }
 
-    headers = {
-        'accept': 'application/json'
-    }
-
-    response = requests.post(url, headers=headers, files=files)
+    try:
+        response = session.post(BRICKOGNIZE_URL, files=files, timeout=timeout)
+    except requests.RequestException as e:
+        print(f"Erreur Brickognize : {e}")
+        return pd.DataFrame()
 
     if response.status_code == 200:
         response_json = response.json()
@@ -51,3 +74,46 @@ def classify_part(img_data):
     else:
         print(f"Erreur {response.status_code}: {response.text}")
         return pd.DataFrame()
+
+
+def classify_parts(images,
+                   max_workers=BRICKOGNIZE_CONCURRENCY,
+                   progress=None,
+                   cache=None):
+    """
+    Analyse plusieurs images via Brickognize en parallèle, avec au plus
+    max_workers appels simultanés.
+
+    Args:
+        images (list[bytes]): Images JPEG à analyser.
+        max_workers (int): Nombre maximal d'appels simultanés.
+        progress (callable): Appelée avec (nombre d'images traitées, nombre
+            d'images) après chaque image traitée.
+        cache (ClassificationCache): Si fourni, les images proches d'une image
+            déjà classée n'appellent pas Brickognize, et les nouveaux
+            résultats y sont ajoutés.
+
+    Returns:
+        list[pd.DataFrame]: Les résultats de classify_part, dans l'ordre des images.
+    """
+    if not images:
+        return []
+    done = 0
+    lock = threading.Lock()
+
+    def _classify_part(img_data):
+        nonlocal done
+        df = cache.get(img_data) if cache is not None else None
+        if df is None:
+            df = classify_part(img_data)
+            if cache is not None:
+                cache.put(img_data, df)
+        if progress is not None:
+            with lock:
+                done += 1
+                progress(done, len(images))
+        return df
+
+    with ThreadPoolExecutor(max_workers=min(max_workers,
+                                            len(images))) as executor:
+        return list(executor.map(_classify_part, images))
@@ -0,0 +1,74 @@
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+
+def canonical_parts(list_part_num: list) -> tuple:
+    '''
+    Forme canonique d'une liste de pièces : les quantités d'un même couple
+    (part_num, color_id) sont sommées et les couples triés. Deux listes ne
+    différant que par l'ordre ou le découpage des lignes ont donc la même
+    forme canonique.
+    '''
+    quantities = defaultdict(int)
+    for item in list_part_num:
+        quantities[(str(item['part_num']), int(item['color_id']))] += int(
+            item['quantity'])
+    return tuple(sorted((part_num, color_id, quantity)
+                        for (part_num, color_id), quantity in quantities.items()))
+
+
+class ResultCache:
+    '''
+    Cache LRU borné, avec durée de vie, des résultats de suggestion de sets.
+
+    La clé contient la version du catalogue : un rafraîchissement du
+    catalogue invalide donc naturellement les résultats précédents, qui
+    finissent par être évincés.
+    '''
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(list_part_num: list, catalog_version: str, **params) -> tuple:
+        '''Clé d'une requête : pièces canoniques, version et paramètres'''
+        return (catalog_version, canonical_parts(list_part_num),
+                tuple(sorted(params.items())))
+
+    def get(self, key):
+        '''Renvoie le résultat associé à key, ou None s'il est absent ou expiré'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            }
@@ -0,0 +1,499 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import traceback
+from urllib import request
+from urllib.error import HTTPError
+
+import pandas as pd
+
+from legolas.completion.index import PartIndex
+from legolas.completion.scoring import ScoringEngine
+from legolas.completion.main import REBRICKABLE_DOWNLOADS_URL
+from legolas.completion.requirements import flatten_requirements
+from legolas.completion.equivalence import canonical_part_codes
+from legolas.completion.part_ids import PartIdIndex, build_part_colors
+
+# dossier où sont stockés les dumps téléchargés et les catalogues convertis
+# (un sous-dossier par version)
+CATALOG_DIR = os.getenv('LEGOLAS_CATALOG_DIR', '/tmp/legolas_catalog')
+
+# correspondances BrickLink -> Rebrickable confirmées par l'API (cf.
+# PartIdIndex), communes à toutes les versions du catalogue : celles qui
+# diffèrent de l'identité, et les identifiants confirmés identiques
+BRICKLINK_OVERRIDES_FILE = 'bricklink_ids.json'
+BRICKLINK_CONFIRMED_FILE = 'bricklink_ids.confirmed.json'
+
+# intervalle (en secondes) entre deux vérifications des dumps Rebrickable
+CATALOG_REFRESH_INTERVAL = int(
+    os.getenv('LEGOLAS_CATALOG_REFRESH_INTERVAL', 6 * 3600))
+# tant qu'aucun catalogue n'est chargé, un rafraîchissement en échec est
+# retenté après un délai croissant (en secondes), borné par ce maximum
+CATALOG_RETRY_MAX_INTERVAL = int(
+    os.getenv('LEGOLAS_CATALOG_RETRY_MAX_INTERVAL', 300))
+# nombre de versions du catalogue gardées sur disque après un
+# rafraîchissement : d'autres processus peuvent encore charger les
+# précédentes
+CATALOG_KEEP_VERSIONS = int(os.getenv('LEGOLAS_CATALOG_KEEP_VERSIONS', 2))
+
+# types des colonnes lues dans chaque table. Les chaînes répétées sont lues
+# en catégories puis internées dans les vocabulaires ci-dessous, les entiers
+# sont ensuite réduits au type le plus étroit possible.
+CATALOG_DTYPES = {
+    'inventories': {
+        'id': 'int32',
+        'version': 'int16',
+        'set_num': 'category',
+    },
+    'inventory_parts': {
+        'inventory_id': 'int32',
+        'part_num': 'category',
+        'color_id': 'int16',
+        'quantity': 'int32',
+        'is_spare': 'bool',
+    },
+    'inventory_minifigs': {
+        'inventory_id': 'int32',
+        'fig_num': 'category',
+        'quantity': 'int32',
+    },
+    'inventory_sets': {
+        'inventory_id': 'int32',
+        'set_num': 'category',
+        'quantity': 'int32',
+    },
+    'part_relationships': {
+        'rel_type': 'category',
+        'child_part_num': 'category',
+        'parent_part_num': 'category',
+    },
+    'sets': {
+        'set_num': 'category',
+        'name': 'string',
+        'year': 'int16',
+        'theme_id': 'int16',
+        'num_parts': 'int32',
+        'img_url': 'string',
+    },
+    'parts': {
+        'part_num': 'category',
+    },
+    'colors': {
+        'id': 'int16',
+        'name': 'string',
+    },
+    'elements': {
+        'element_id': 'string',
+        'part_num': 'category',
+        'color_id': 'int16',
+    },
+}
+
+# à incrémenter à chaque changement du format des fichiers parquet : la
+# version d'un catalogue en dépend, un ancien catalogue est donc reconstruit
+CATALOG_FORMAT = 5
+
+# vocabulaires partagés entre tables : chaque colonne listée est stockée sous
+# forme de codes entiers, vocabulaire[code] redonnant la valeur d'origine
+CATALOG_VOCABULARIES = {
+    'part_num': [('inventory_parts', 'part_num'),
+                 ('part_relationships', 'child_part_num'),
+                 ('part_relationships', 'parent_part_num'),
+                 ('parts', 'part_num'), ('elements', 'part_num')],
+    'set_num': [('inventories', 'set_num'), ('sets', 'set_num'),
+                ('inventory_minifigs', 'fig_num'),
+                ('inventory_sets', 'set_num')],
+}
+
+# tables gardées en mémoire par l'API, dont trois calculées à la
+# construction du catalogue : requirements, les pièces de chaque inventaire y
+# compris celles de ses minifigs et sous-sets (cf. flatten_requirements),
+# part_equivalences, le code canonique de chaque pièce
+# (cf. canonical_part_codes), et part_colors, les couleurs existantes de
+# chaque pièce (cf. build_part_colors)
+CATALOG_RESIDENT_TABLES = [
+    'inventories', 'sets', 'requirements', 'part_equivalences',
+    'part_colors', 'colors'
+]
+
+
+class Catalog:
+    '''
+    Tables Rebrickable d'une version donnée, chargées une seule fois et
+    gardées en mémoire par l'API, avec l'index part_num -> inventory_id et le
+    moteur de calcul des pourcentages associés.
+
+    Les part_num et set_num des tables sont des codes entiers : les
+    vocabulaires part_nums et set_nums permettent de les décoder en sortie
+    d'API (cf. decode_set_nums).
+
+    Un second index et un second moteur, dits tolérants, sont construits sur
+    les besoins dont chaque pièce est remplacée par sa pièce canonique : une
+    variante de moule ou d'impression y correspond à la pièce du set. La
+    canonicalisation étant faite au chargement, une requête tolérante ne
+    coûte que la traduction de sa liste de pièces (cf. canonical_part_list).
+
+    part_ids résout les identifiants BrickLink et les couleurs des pièces
+    sans appel à l'API Rebrickable (cf. PartIdIndex).
+    '''
+
+    def __init__(self,
+                 version: str,
+                 tables: dict,
+                 vocabularies: dict,
+                 overrides_path: str = None,
+                 confirmed_path: str = None):
+        self.version = version
+        self.part_nums = vocabularies['part_num']
+        self.set_nums = vocabularies['set_num']
+        self.inventories = tables['inventories']
+        self.sets = tables['sets']
+        # les besoins des sets ne sont gardés que sous leur forme indexée
+        self.part_index = PartIndex(tables['requirements'], self.part_nums)
+        self.scoring_engine = ScoringEngine(self.part_index)
+
+        self.canonical_codes = tables['part_equivalences'][
+            'canonical'].to_numpy()
+        requirements = tables['requirements']
+        self.tolerant_part_index = PartIndex(
+            requirements.assign(part_num=self.canonical_codes[
+                requirements['part_num'].to_numpy()]), self.part_nums)
+        self.tolerant_scoring_engine = ScoringEngine(self.tolerant_part_index)
+
+        self.part_ids = PartIdIndex(self.part_index.part_codes,
+                                    tables['part_colors'], tables['colors'],
+                                    overrides_path, confirmed_path)
+
+    def canonical_part_list(self, list_part_num: list) -> list:
+        '''
+        Remplace chaque part_num de la liste par le part_num canonique de sa
+        classe d'équivalence (les pièces inconnues sont laissées telles
+        quelles).
+        '''
+        part_codes = self.part_index.part_codes
+        return [
+            dict(item,
+                 part_num=self.part_nums[self.canonical_codes[part_codes[
+                     item['part_num']]]])
+            if item['part_num'] in part_codes else item
+            for item in list_part_num
+        ]
+
+    def decode_set_nums(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''Remplace les codes de la colonne set_num par les numéros de set'''
+        return df.assign(set_num=self.set_nums[df['set_num'].to_numpy()])
+
+
+def _temp_file(path: str):
+    '''
+    Fichier temporaire au nom unique, à côté de path : plusieurs processus
+    (le serveur, scripts/download_csv.py) peuvent écrire le même fichier.
+    Renvoie le descripteur et le chemin, à renommer en path une fois écrit.
+    '''
+    return tempfile.mkstemp(prefix=f'.{os.path.basename(path)}-',
+                            suffix='.tmp',
+                            dir=os.path.dirname(path))
+
+
+def _write_atomic(path: str, content: str):
+    '''Ecrit un fichier texte sous un nom temporaire puis le renomme'''
+    fd, tmp_path = _temp_file(path)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def fetch_dump(name: str,
+               catalog_dir: str = CATALOG_DIR,
+               base_url: str = REBRICKABLE_DOWNLOADS_URL) -> dict:
+    '''
+    Télécharge le dump Rebrickable {name}.csv.gz dans catalog_dir/dumps par
+    une requête conditionnelle (ETag / Last-Modified) : un dump inchangé
+    depuis le dernier téléchargement n'est pas retéléchargé.
+    Le fichier et ses métadonnées sont écrits sous des noms temporaires
+    uniques puis renommés.
+
+    Renvoie les métadonnées du dump : chemin, ETag, Last-Modified et sha1 du
+    contenu.
+    '''
+    dumps_dir = os.path.join(catalog_dir, 'dumps')
+    os.makedirs(dumps_dir, exist_ok=True)
+    path = os.path.join(dumps_dir, f'{name}.csv.gz')
+    meta_path = f'{path}.json'
+
+    meta = {}
+    if os.path.isfile(path) and os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    req = request.Request(f'{base_url}/{name}.csv.gz')
+    if meta.get('etag'):
+        req.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        req.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        with request.urlopen(req, timeout=60) as response:
+            sha1 = hashlib.sha1()
+            fd, tmp_path = _temp_file(path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in iter(lambda: response.read(1 << 20), b''):
+                        sha1.update(chunk)
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            meta = {
+                'path': path,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'sha1': sha1.hexdigest(),
+            }
+            _write_atomic(meta_path, json.dumps(meta))
+    except HTTPError as err:
+        # 304 Not Modified : on garde le dump déjà présent
+        if err.code != 304 or not meta:
+            raise
+
+    return meta
+
+
+def build_catalog(version: str, dumps: dict,
+                  catalog_dir: str = CATALOG_DIR) -> str:
+    '''
+    Convertit les dumps gzippés en fichiers parquet typés, dans un dossier
+    temporaire renommé en catalog_dir/version une fois complet : un lecteur
+    ne voit donc jamais un catalogue à moitié écrit. Si un autre processus
+    a construit la même version entre-temps, la sienne est gardée.
+    Renvoie le dossier du catalogue.
+    '''
+    version_dir = os.path.join(catalog_dir, version)
+    if os.path.isdir(version_dir):
+        return version_dir
+
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{version}-', dir=catalog_dir)
+    try:
+        tables = {
+            table: pd.read_csv(dumps[table]['path'],
+                               compression='gzip',
+                               header=0,
+                               sep=',',
+                               usecols=list(dtypes),
+                               dtype=dtypes,
+                               true_values=['t', 'True'],
+                               false_values=['f', 'False'],
+                               on_bad_lines='skip')
+            for table, dtypes in CATALOG_DTYPES.items()
+        }
+
+        # internement des chaînes dans les vocabulaires partagés
+        vocabularies = {}
+        for name, columns in CATALOG_VOCABULARIES.items():
+            vocabulary = pd.Index(
+                sorted(set().union(*(tables[table][column].cat.categories
+                                     for table, column in columns))))
+            vocabularies[name] = vocabulary
+            for table, column in columns:
+                tables[table][column] = vocabulary.get_indexer(
+                    tables[table][column].astype(object))
+            pd.DataFrame({
+                name: vocabulary
+            }).to_parquet(os.path.join(tmp_dir, f'{name}.vocab.parquet'),
+                          index=False)
+
+        tables['requirements'] = flatten_requirements(
+            tables['inventories'], tables['inventory_parts'],
+            tables['inventory_minifigs'], tables['inventory_sets'])
+        tables['part_equivalences'] = pd.DataFrame({
+            'canonical':
+            canonical_part_codes(tables['part_relationships'],
+                                 len(vocabularies['part_num']))
+        })
+        tables['part_colors'] = build_part_colors(tables['inventories'],
+                                                  tables['inventory_parts'],
+                                                  tables['elements'])
+
+        for table, df in tables.items():
+            for column in df.select_dtypes('integer'):
+                df[column] = pd.to_numeric(df[column], downcast='integer')
+            df.to_parquet(os.path.join(tmp_dir, f'{table}.parquet'),
+                          index=False)
+        os.rename(tmp_dir, version_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.isdir(version_dir):
+            return version_dir
+        raise
+
+    return version_dir
+
+
+def _prune_versions(catalog_dir: str, keep: int, in_use: set):
+    '''
+    Supprime les versions du catalogue autres que les keep plus récentes,
+    celles de in_use et celle désignée par CURRENT (éventuellement écrite
+    par un autre processus). Les dossiers temporaires des constructions en
+    cours (préfixe '.') ne sont pas touchés.
+    '''
+    current_path = os.path.join(catalog_dir, 'CURRENT')
+    if os.path.isfile(current_path):
+        with open(current_path) as f:
+            in_use = in_use | {f.read().strip()}
+    versions = sorted(
+        (entry for entry in os.scandir(catalog_dir)
+         if entry.is_dir() and not entry.name.startswith('.') and
+         entry.name != 'dumps'),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True)
+    for entry in versions[keep:]:
+        if entry.name not in in_use:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def load_catalog(version: str = None,
+                 catalog_dir: str = CATALOG_DIR) -> Catalog:
+    '''
+    Charge un catalogue depuis ses fichiers parquet. Sans version, charge la
+    version courante (fichier CURRENT), ou renvoie None si aucun catalogue
+    n'a encore été construit.
+    '''
+    if version is None:
+        current_path = os.path.join(catalog_dir, 'CURRENT')
+        if not os.path.isfile(current_path):
+            return None
+        with open(current_path) as f:
+            version = f.read().strip()
+
+    version_dir = os.path.join(catalog_dir, version)
+    tables = {
+        table: pd.read_parquet(os.path.join(version_dir, f'{table}.parquet'))
+        for table in CATALOG_RESIDENT_TABLES
+    }
+    vocabularies = {
+        name: pd.read_parquet(
+            os.path.join(version_dir,
+                         f'{name}.vocab.parquet'))[name].to_numpy(dtype=object)
+        for name in CATALOG_VOCABULARIES
+    }
+    return Catalog(version, tables, vocabularies,
+                   os.path.join(catalog_dir, BRICKLINK_OVERRIDES_FILE),
+                   os.path.join(catalog_dir, BRICKLINK_CONFIRMED_FILE))
+
+
+class CatalogManager:
+    '''
+    Garde en mémoire le catalogue courant et le rafraîchit en tâche de fond.
+
+    A chaque rafraîchissement, les dumps sont revérifiés par requêtes
+    conditionnelles. Si l'un d'eux a changé, la nouvelle version est
+    construite à côté de l'ancienne, chargée, puis substituée à l'ancienne en
+    une seule affectation : les requêtes en cours gardent leur catalogue et
+    ne voient jamais un catalogue partiel ni la latence du téléchargement.
+    '''
+
+    def __init__(self,
+                 catalog_dir: str = CATALOG_DIR,
+                 base_url: str = REBRICKABLE_DOWNLOADS_URL,
+                 refresh_interval: int = CATALOG_REFRESH_INTERVAL):
+        self.catalog_dir = catalog_dir
+        self.base_url = base_url
+        self.refresh_interval = refresh_interval
+        self.catalog = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        os.makedirs(catalog_dir, exist_ok=True)
+
+    def get(self, timeout: float = None) -> Catalog:
+        '''
+        Renvoie le catalogue courant. Seul le tout premier démarrage, sans
+        catalogue sur disque, attend la fin du premier rafraîchissement.
+        '''
+        self._ready.wait(timeout)
+        return self.catalog
+
+    def _swap(self, catalog: Catalog):
+        self.catalog = catalog
+        self._ready.set()
+
+    def refresh(self) -> bool:
+        '''
+        Vérifie les dumps et installe une nouvelle version du catalogue si
+        nécessaire. Renvoie True si le catalogue a changé.
+        '''
+        with self._refresh_lock:
+            dumps = {
+                table: fetch_dump(table, self.catalog_dir, self.base_url)
+                for table in CATALOG_DTYPES
+            }
+            version = hashlib.sha1(''.join(
+                [str(CATALOG_FORMAT)] +
+                [dumps[table]['sha1']
+                 for table in CATALOG_DTYPES]).encode()).hexdigest()[:12]
+
+            if self.catalog is not None and self.catalog.version == version:
+                return False
+
+            build_catalog(version, dumps, self.catalog_dir)
+            catalog = load_catalog(version, self.catalog_dir)
+            _write_atomic(os.path.join(self.catalog_dir, 'CURRENT'), version)
+            previous = self.catalog
+            self._swap(catalog)
+
+            # les versions plus anciennes ne sont plus utilisées ici ; les
+            # plus récentes peuvent l'être par d'autres processus
+            if previous is not None and previous.version != version:
+                _prune_versions(self.catalog_dir, CATALOG_KEEP_VERSIONS,
+                                {version})
+            return True
+
+    def _run(self):
+        retry_interval = 5
+        while not self._stop.is_set():
+            interval = self.refresh_interval
+            try:
+                if self.refresh():
+                    print(f"catalog: version {self.catalog.version} loaded")
+            except Exception:
+                print("catalog: refresh failed, keeping current catalog")
+                traceback.print_exc()
+                # sans catalogue, les requêtes attendent : on réessaie vite
+                if self.catalog is None:
+                    interval = min(retry_interval, self.refresh_interval)
+                    retry_interval = min(retry_interval * 2,
+                                         CATALOG_RETRY_MAX_INTERVAL)
+            self._stop.wait(interval)
+
+    def start(self):
+        '''
+        Charge le dernier catalogue construit s'il existe, puis lance le
+        rafraîchissement périodique dans un thread de fond.
+        '''
+        try:
+            catalog = load_catalog(catalog_dir=self.catalog_dir)
+        except Exception:
+            catalog = None
+            traceback.print_exc()
+        if catalog is not None:
+            self._swap(catalog)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='catalog-refresh',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
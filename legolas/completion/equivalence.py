@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+# types de relation de part_relationships.csv considérés comme la même pièce
+# pour la construction d'un set : P (impression), M (moule), T (motif) et
+# A (alternative). R (paire) et B (sous-pièce) relient des pièces distinctes.
+EQUIVALENT_REL_TYPES = ['P', 'M', 'T', 'A']
+
+
+def canonical_part_codes(part_relationships: pd.DataFrame,
+                         n_parts: int) -> np.ndarray:
+    '''
+    Regroupe les pièces équivalentes (ex : 3069b et 3069bpr0001) en classes,
+    chaque classe étant représentée par son plus petit code.
+
+    INPUT :
+        part_relationships : la table part_relationships, dont les colonnes
+            child_part_num et parent_part_num contiennent des codes de pièces
+        n_parts : taille du vocabulaire des pièces
+
+    OUTPUT :
+        un tableau canonical tel que canonical[code] est le code représentant
+        la classe de la pièce code (lui-même pour une pièce sans équivalent)
+    '''
+    relations = part_relationships[part_relationships['rel_type'].isin(
+        EQUIVALENT_REL_TYPES)]
+    children = relations['child_part_num'].to_numpy()
+    parents = relations['parent_part_num'].to_numpy()
+    # on ignore les relations vers des pièces absentes du vocabulaire
+    known = (children >= 0) & (parents >= 0)
+
+    # les classes sont les composantes connexes du graphe des relations
+    graph = sparse.coo_matrix(
+        (np.ones(known.sum(), dtype=np.int8), (children[known], parents[known])),
+        shape=(n_parts, n_parts))
+    _, labels = connected_components(graph, directed=False)
+
+    representatives = np.full(labels.max(initial=-1) + 1, n_parts,
+                              dtype=np.int64)
+    np.minimum.at(representatives, labels, np.arange(n_parts))
+    return representatives[labels].astype(np.int32)
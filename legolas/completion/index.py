@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+
+class PartIndex:
+    '''
+    Index inversé part_num -> inventory_id, construit une seule fois par
+    chargement du catalogue.
+
+    Les part_num sont internés en codes entiers (part_nums[code] == part_num).
+    Les lignes de inventory_parts (hors pièces de rechange) sont triées par
+    inventory_id : les lignes d'un inventaire forment donc une tranche
+    contiguë, retrouvée par recherche dichotomique. De même, les inventaires
+    contenant chaque pièce sont rangés en tranches contiguës d'un seul
+    tableau, indexées par code de pièce. Les recherches se font sur le
+    part_num exact ('3003' ne correspond plus à '3003pr01').
+    '''
+
+    def __init__(self,
+                 df_inventory_parts: pd.DataFrame,
+                 part_nums: np.ndarray = None):
+        '''
+        df_inventory_parts : les lignes de inventory_parts (ou des besoins
+            aplatis, sans colonne is_spare). Si part_nums est fourni, la
+            colonne part_num contient les codes des pièces dans part_nums,
+            sinon les part_num eux-mêmes.
+        '''
+        # on ne garde que les pièces du set (pas le spare), triées par inventaire
+        parts = df_inventory_parts
+        if 'is_spare' in parts.columns:
+            parts = parts[parts['is_spare'] == False]
+        parts = parts[['inventory_id', 'part_num', 'color_id', 'quantity']]
+        if part_nums is None:
+            codes, part_nums = pd.factorize(parts['part_num'].astype(str))
+            parts = parts.assign(part_num=codes.astype(np.int32))
+        self.part_nums = np.asarray(part_nums, dtype=object)
+        self.part_codes = {
+            part_num: code
+            for code, part_num in enumerate(self.part_nums)
+        }
+        self.parts = parts.sort_values('inventory_id',
+                                       kind='stable').reset_index(drop=True)
+
+        # bornes [début, fin[ des lignes de chaque inventaire
+        inventory_ids = self.parts['inventory_id'].to_numpy()
+        self.inventory_ids, starts = np.unique(inventory_ids,
+                                               return_index=True)
+        self._bounds = np.append(starts, len(inventory_ids))
+
+        # code de pièce -> inventory_id (triés, uniques) contenant cette pièce
+        pairs = np.unique(
+            np.stack([self.parts['part_num'].to_numpy().astype(np.int64),
+                      inventory_ids.astype(np.int64)]),
+            axis=1)
+        self._part_inventories = pairs[1].astype(inventory_ids.dtype)
+        self._part_bounds = np.searchsorted(pairs[0],
+                                            np.arange(len(self.part_nums) + 1))
+
+    def inventories_for(self, part_nums) -> np.ndarray:
+        '''
+        Renvoie les inventory_id (triés, uniques) contenant au moins une des
+        pièces de part_nums.
+        '''
+        codes = {self.part_codes[part_num] for part_num in part_nums
+                 if part_num in self.part_codes}
+        found = [
+            self._part_inventories[self._part_bounds[code]:
+                                   self._part_bounds[code + 1]]
+            for code in codes
+        ]
+        if not found:
+            return np.array([], dtype=self.inventory_ids.dtype)
+        return np.unique(np.concatenate(found))
+
+    def rows_for(self, inventory_ids) -> pd.DataFrame:
+        '''
+        Renvoie toutes les lignes (hors spare) des inventaires demandés, sans
+        parcourir l'ensemble de inventory_parts. Les part_num sont décodés.
+        '''
+        inventory_ids = np.asarray(inventory_ids)
+        if len(self.inventory_ids) == 0 or len(inventory_ids) == 0:
+            rows = np.array([], dtype=np.int64)
+        else:
+            positions = np.searchsorted(self.inventory_ids, inventory_ids)
+            positions = positions[(positions < len(self.inventory_ids)) & (
+                self.inventory_ids[np.minimum(positions,
+                                              len(self.inventory_ids) - 1)]
+                == inventory_ids)]
+            starts = self._bounds[positions]
+            lengths = self._bounds[positions + 1] - starts
+            # concaténation vectorisée des plages [début, fin[
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths,
+                                lengths)
+            rows = np.arange(lengths.sum()) + offsets
+        df = self.parts.iloc[rows]
+        return df.assign(part_num=self.part_nums[df['part_num'].to_numpy()])
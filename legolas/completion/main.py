@@ -8,6 +8,9 @@ import shutil
 import ast
 from collections import defaultdict
 
+from legolas.completion.index import PartIndex
+from legolas.completion.scoring import ScoringEngine, top_k
+
 
 # Functions:
 def purge(dir: str, pattern: str):
@@ -19,6 +22,36 @@ def purge(dir: str, pattern: str):
             os.remove(os.path.join(dir, f))
 
 
+# peut pointer vers un serveur local servant les mêmes fichiers (tests)
+REBRICKABLE_DOWNLOADS_URL = os.getenv(
+    'REBRICKABLE_DOWNLOADS_URL',
+    'https://cdn.rebrickable.com/media/downloads')
+
+
+def download_dated_gz(name: str, tmp_dir: str = '/tmp') -> str:
+    '''
+    Télécharge le dump Rebrickable {name}.csv.gz du jour dans tmp_dir s'il
+    n'est pas déjà présent, sous le nom {name}.csv_AAMMJJ.gz. Les dumps des
+    jours passés sont effacés.
+    Renvoie le chemin du fichier gz du jour.
+    '''
+    # date du jour
+    today = datetime.date.today()
+    today_f = datetime.datetime.strftime(today, '%y%m%d')
+
+    # lien de sauvegarde du gz renommé
+    file_path = f'{tmp_dir}/{name}.csv_{today_f}.gz'
+
+    # si le fichier gz daté du jour existe déjà, on ne le retélécharge pas.
+    # sinon, on efface l'ancien gz avant de télécharger celui du jour.
+    if not os.path.isfile(file_path):
+        purge(tmp_dir, rf'^{name}\.csv_\d{{6}}\.gz$')
+        request.urlretrieve(url=f'{REBRICKABLE_DOWNLOADS_URL}/{name}.csv.gz',
+                            filename=file_path)
+
+    return file_path
+
+
 def download_csv_files() -> pd.DataFrame:
     '''
     Récupère les csv du jour s'il ne sont pas déjà présents dans le dossier
@@ -26,65 +59,10 @@ def download_csv_files() -> pd.DataFrame:
     et on les remplace par les gz du jour.
     On les unzip et au final on créé les dataframe.
     '''
-    # récupération des csv
-    # url
-    inventories_path = 'https://cdn.rebrickable.com/media/downloads/inventories.csv.gz'
-    inventories_parts_path = 'https://cdn.rebrickable.com/media/downloads/inventory_parts.csv.gz'
-    sets_path = 'https://cdn.rebrickable.com/media/downloads/sets.csv.gz'
-
-    # date du jour
-    today = datetime.date.today()
-    today_f = datetime.datetime.strftime(today, '%y%m%d')
-
-    # on récupère les noms des fichiers
-    inventories_name = re.split(pattern='/', string=inventories_path)[-1]
-    inventories_parts_name = re.split(pattern='/',
-                                      string=inventories_parts_path)[-1]
-    sets_path_name = re.split(pattern='/', string=sets_path)[-1]
-
-    # ajout today date aux noms des ficheirs gz
-    inventories_dated_name = inventories_name[:-3] + "_" + today_f + '.gz'
-    inventories_parts_dated_name = inventories_parts_name[:
-                                                          -3] + "_" + today_f + '.gz'
-    sets_dated_name = sets_path_name[:-3] + "_" + today_f + '.gz'
-
-    # liens de sauvegarde des gz renommés
-    tmp_dir = '/tmp'  # os.path.dirname(__file__) +
-    file_inventories_path = f'{tmp_dir}/{inventories_dated_name}'
-    file_inventories_parts_path = f'{tmp_dir}/{inventories_parts_dated_name}'
-    file_sets_path = f'{tmp_dir}/{sets_dated_name}'
-
-    # si les fichier gz datés du jour existent déjà, on ne les retélécharge pas.
-    # sinon, on efface l'ancien gz et les csv unzippés.
-    if not os.path.isfile(file_inventories_path):
-        # s'il n'existe pas, on efface l'ancien fichier csv et gz
-        # s'il existe, on ne fait rien (on ne redl pas et on ne dezip pas)
-        dir = os.listdir(tmp_dir)
-        # Checking if the list is empty or not
-        if len(dir) > 0:
-            purge(tmp_dir, '/inventories.csv')
-
-        r_inv = request.urlretrieve(url=inventories_path,
-                                    filename=file_inventories_path)
-
-    if not os.path.isfile(file_inventories_parts_path):
-        # s'il n'existe pas on efface l'ancien fichier csv et gz
-        # s'il existe, on ne fait rien (on ne redl pas et on ne dezip pas)
-        dir = os.listdir(tmp_dir)
-        # Checking if the list is empty or not
-        if len(dir) > 0:
-            purge(tmp_dir, '/inventory_parts.csv')
-        r_inv_parts = request.urlretrieve(url=inventories_parts_path,
-                                          filename=file_inventories_parts_path)
-
-    if not os.path.isfile(file_sets_path):
-        # s'il n'existe pas on efface l'ancien fichier csv et gz
-        # s'il existe, on ne fait rien (on ne redl pas et on ne dezip pas)
-        dir = os.listdir(tmp_dir)
-        # Checking if the list is empty or not
-        if len(dir) > 0:
-            purge(tmp_dir, '/sets.csv')
-        r_sets = request.urlretrieve(url=sets_path, filename=file_sets_path)
+    # récupération des gz du jour
+    file_inventories_path = download_dated_gz('inventories')
+    file_inventories_parts_path = download_dated_gz('inventory_parts')
+    file_sets_path = download_dated_gz('sets')
 
     # creations dataframes
     df_inventories = pd.read_csv(file_inventories_path,
@@ -242,7 +220,8 @@ def generate_test_liste_part_disponible() -> list:
 def list_set_contenant_au_moins_une_des_pieces(list_part_num: dict,
                                                nombre_part_min_par_set: int = 5,
                                                df_inventories: pd.DataFrame = None,
-                                               df_inventory_parts: pd.DataFrame = None
+                                               df_inventory_parts: pd.DataFrame = None,
+                                               part_index: PartIndex = None
                                                ) -> pd.DataFrame:
     '''
     Sur la base d'un dictionnaire de part_num disponibles (list_part_num), la
@@ -263,6 +242,9 @@ def list_set_contenant_au_moins_une_des_pieces(list_part_num: dict,
                             {...},...
         ]
         nombre_part_min_par_set : entier, par défaut égal à 5
+        part_index : index inversé part_num -> inventory_id construit au
+            chargement du catalogue. S'il n'est pas fourni, il est construit à
+            partir de df_inventory_parts (coûteux : à éviter à chaque requête).
 
     OUTPUT :
         une dataframe avec une ligne par set
@@ -281,30 +263,35 @@ def list_set_contenant_au_moins_une_des_pieces(list_part_num: dict,
 
     liste_pieces = [elem['part_num'] for elem in list_part_num]
 
-    # on récupère uniquement les lignes des pièces du set et pas le spare
-    df_set_sans_spare = df_inventory_parts[df_inventory_parts['is_spare'] ==
-                                           False].copy().reset_index(drop=True)
-    # on créé un pattern avec toutes les pièces pour filtrer le dataframe
-    pattern = '|'.join(liste_pieces)
-    mask = df_set_sans_spare['part_num'].str.contains(pattern).fillna(False)
+    if part_index is None:
+        part_index = PartIndex(df_inventory_parts)
+
+    # on récupère la liste des inventory_id citant exactement une des pièces
+    liste_inventory_id_cites_unique = part_index.inventories_for(liste_pieces)
 
-    # on récupère la dataframe
-    df = df_set_sans_spare[mask].copy().reset_index(drop=True)
+    # on récupère l'ensemble des lignes (hors spare) des sets possibles
+    df_filtree_set_pertinents = part_index.rows_for(
+        liste_inventory_id_cites_unique).copy()
 
-    # on récupère la liste des inventory_id uniques
-    liste_inventory_id_cites_unique = df['inventory_id'].unique()
+    return aggregate_sets_df(df_filtree_set_pertinents,
+                             nombre_part_min_par_set, df_inventories)
 
-    # on récupère l'ensemble des lignes du dataframe initial pour lequel
-    # le inventory id est dans la liste des set possible.
-    df_filtree_set_pertinents = df_set_sans_spare[df_set_sans_spare[
-        'inventory_id'].isin(liste_inventory_id_cites_unique)].copy()
 
+def aggregate_sets_df(df_filtree_set_pertinents: pd.DataFrame,
+                      nombre_part_min_par_set: int,
+                      df_inventories: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Agrège les lignes de inventory_parts (hors spare) des sets retenus en
+    une ligne par set, au format décrit dans
+    list_set_contenant_au_moins_une_des_pieces.
+    '''
     # fonction pour aggreger les part num
     def f(x): return ','.join(sorted(list(set(x))))
 
     # on créé une dataframe avec la concaténation des part_num
     df_2 = df_filtree_set_pertinents.groupby(
-        'inventory_id', as_index=False).agg(part_num_agg=('part_num', f))
+        'inventory_id', as_index=False,
+        observed=True).agg(part_num_agg=('part_num', f))
     # on créé une colonne avec la concaténation des part_num, qty et color dans une liste
     # df['part_num_qty_color']=df[['part_num', 'quantity', 'color_id']].values.tolist()
     # print(df_2)
@@ -324,8 +311,8 @@ def list_set_contenant_au_moins_une_des_pieces(list_part_num: dict,
     # pour un même part_num mais sous différentes couleurs. Ca fausse le count
     # si on fait tout d'un coup
     df_3 = df_filtree_set_pertinents.groupby(
-        ['inventory_id', 'part_num'],
-        as_index=False).agg(count_nb_part_different=('part_num', 'count'),
+        ['inventory_id', 'part_num'], as_index=False,
+        observed=True).agg(count_nb_part_different=('part_num', 'count'),
                             quantity_total_part_num=('quantity', "sum"))
     # print(df_3)
     # on groupby la précédent df sur les inventaire pour avoir le bon
@@ -541,10 +528,12 @@ def compute_colour_match(row, available_qty: dict,
 
 
 def generate_final_df(sets_df: pd.DataFrame, available_qty: dict,
-                      available_qty_no_color: dict, df_sets) -> pd.DataFrame:
+                      available_qty_no_color: dict, df_sets,
+                      engine: ScoringEngine = None,
+                      k: int = 10) -> pd.DataFrame:
     '''
     Fonction générant les résultats finaux:
-    On récupère les 10 sets les plus faisables, que l'on tienne compte ou
+    On récupère les k (10 par défaut) sets les plus faisables, que l'on tienne compte ou
     non des couleurs, triés par pourcentage de pièces disponibles.
     On récupère aussi le lien vers la photo des sets.
 
@@ -555,27 +544,71 @@ def generate_final_df(sets_df: pd.DataFrame, available_qty: dict,
         tient compte ou non des couleurs.
         - df_sets : dataframe reliant les numéro de set aux photos hébergées sur
         le site de rebrickable
+        - engine : moteur de calcul des pourcentages construit au chargement
+        du catalogue. S'il n'est pas fourni, il est construit à partir des
+        pièces de sets_df.
+        - k : le nombre de sets à renvoyer
 
     OUTPUT :
-        - les 10 sets les plus faisables si on tient compte des couleurs
-        - les 10 set les plus faisables si on ne tient pas compte des couleurs
+        - les k sets les plus faisables si on tient compte des couleurs
+        - les k set les plus faisables si on ne tient pas compte des couleurs
 
     '''
-    # génération de la dataframe globale
-    colour_metrics = sets_df.apply(lambda x: compute_colour_match(
-        x, available_qty, available_qty_no_color),
+    # aucun set candidat (pièces inconnues...) ou k nul : résultats vides
+    if sets_df.empty or k < 1:
+        set_num = sets_df['set_num'] if 'set_num' in sets_df else pd.Series(
+            dtype='int64')
+        empty = pd.DataFrame({
+            'inventory_id': pd.Series(dtype='int64'),
+            'set_num': set_num.iloc[:0],
+            'img_url': pd.Series(dtype='object')
+        })
+        return (empty.assign(percent_no_colour=pd.Series(dtype='float64'),
+                             missing_without_color=pd.Series(dtype='object'),
+                             extra_part_without_color=pd.Series(
+                                 dtype='object')),
+                empty.assign(percent_colour_match=pd.Series(dtype='float64'),
+                             missing_exact_parts=pd.Series(dtype='object'),
+                             **{'extra part with color':
+                                pd.Series(dtype='object')}))
+
+    # pourcentages de pièces disponibles de tous les sets candidats, calculés
+    # en une fois sur les matrices creuses
+    if engine is None:
+        exploded = sets_df[['inventory_id', 'part_num_qty_color'
+                            ]].explode('part_num_qty_color')
+        parts = pd.DataFrame(exploded['part_num_qty_color'].tolist(),
+                             columns=['part_num', 'quantity', 'color_id'])
+        parts['inventory_id'] = exploded['inventory_id'].to_numpy()
+        engine = ScoringEngine(PartIndex(parts))
+    scores = engine.score(sets_df['inventory_id'], available_qty,
+                          available_qty_no_color)
+    df_total = pd.concat(
+        [sets_df.reset_index(drop=True),
+         scores.drop(columns='inventory_id')],
         axis=1)
-    df_total = pd.concat([sets_df, colour_metrics], axis=1)
-
-    # génération des dataframes des 10 sets les plus faisables si on tient compte des couleurs ou non
-    df_no_color = df_total[[
-        'inventory_id', 'set_num', 'percent_no_colour',
-        'missing_without_color', 'extra_part_without_color'
-    ]].copy().sort_values(ascending=False, by='percent_no_colour').head(10)
-    df_color = df_total[[
-        'inventory_id', 'set_num', 'percent_colour_match',
-        'missing_exact_parts', 'extra part with color'
-    ]].copy().sort_values(ascending=False, by='percent_colour_match').head(10)
+
+    # génération des dataframes des k sets les plus faisables si on tient
+    # compte des couleurs ou non, par sélection partielle. Le détail des
+    # pièces manquantes ou en trop n'est calculé que pour ces sets.
+    def colour_details(df, columns):
+        colour_metrics = df.apply(lambda x: compute_colour_match(
+            x, available_qty, available_qty_no_color),
+            axis=1)
+        return pd.concat([df, colour_metrics[columns]], axis=1)
+
+    df_no_color = colour_details(
+        df_total.iloc[top_k(df_total['percent_no_colour'], k)],
+        ['missing_without_color', 'extra_part_without_color'])[[
+            'inventory_id', 'set_num', 'percent_no_colour',
+            'missing_without_color', 'extra_part_without_color'
+        ]]
+    df_color = colour_details(
+        df_total.iloc[top_k(df_total['percent_colour_match'], k)],
+        ['missing_exact_parts', 'extra part with color'])[[
+            'inventory_id', 'set_num', 'percent_colour_match',
+            'missing_exact_parts', 'extra part with color'
+        ]]
 
     # Transformation des dataframes obtenus pour ne conserver que des lists au
     # lieu des dict
@@ -612,6 +645,47 @@ def generate_final_df(sets_df: pd.DataFrame, available_qty: dict,
     return df_no_color_final_lien, df_color_final_lien
 
 
+def suggest_sets(list_part_num: list, part_index: PartIndex,
+                 engine: ScoringEngine, df_inventories: pd.DataFrame,
+                 df_sets: pd.DataFrame, k: int = 10,
+                 nombre_part_min_par_set: int = 5,
+                 scorer=None) -> pd.DataFrame:
+    '''
+    Equivalent de list_set_contenant_au_moins_une_des_pieces suivi de
+    generate_final_df, sans matérialiser les sets candidats : ceux-ci sont
+    filtrés et notés directement sur l'index et les matrices du catalogue,
+    et seuls les k meilleurs de chaque classement sont agrégés et détaillés.
+    Si scorer (ParallelScorer) est fourni, le calcul des scores est réparti
+    sur son pool de processus.
+
+    OUTPUT :
+        - les k sets les plus faisables si on tient compte des couleurs
+        - les k set les plus faisables si on ne tient pas compte des couleurs
+    '''
+    available_qty, available_qty_no_color = available_part_num_dict(
+        list_part_num)
+
+    # sets candidats ayant suffisamment de part différentes
+    inventory_ids = part_index.inventories_for(available_qty_no_color)
+    inventory_ids = inventory_ids[engine.count_part_num(inventory_ids) >=
+                                  nombre_part_min_par_set]
+
+    # on ne garde que les k meilleurs sets de chaque classement
+    if scorer is not None:
+        winners = scorer.best(inventory_ids, available_qty,
+                              available_qty_no_color, k)
+    else:
+        winners = engine.best_encoded(
+            inventory_ids,
+            engine.encode(available_qty, available_qty_no_color),
+            k)['inventory_id'].to_numpy()
+
+    sets_df = aggregate_sets_df(part_index.rows_for(winners).copy(), 0,
+                                df_inventories)
+    return generate_final_df(sets_df, available_qty, available_qty_no_color,
+                             df_sets, engine=engine, k=k)
+
+
 if __name__ == "__main__":
     # Récupération des csv et génération des dataframes
     df_inventories, df_inventory_parts, df_sets = download_csv_files()
@@ -0,0 +1,154 @@
+import os
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from legolas.completion.scoring import ScoringEngine, top_k
+
+# moteur de calcul d'un processus du pool, reconstruit une seule fois au
+# démarrage du processus à partir de la mémoire partagée
+_worker_engine = None
+_worker_memories = []
+
+
+def _engine_arrays(engine: ScoringEngine) -> dict:
+    '''Tableaux nécessaires au calcul des scores dans un processus du pool'''
+    return {
+        'inventory_ids': engine.inventory_ids,
+        'color_data': engine.required_color.data,
+        'color_indices': engine.required_color.indices,
+        'color_indptr': engine.required_color.indptr,
+        'no_color_data': engine.required_no_color.data,
+        'no_color_indices': engine.required_no_color.indices,
+        'no_color_indptr': engine.required_no_color.indptr,
+    }
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    '''
+    Ouvre un segment de mémoire partagée créé par le processus parent, sans
+    que le processus du pool ne s'en considère propriétaire.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 : le segment est suivi, on le retire du suivi
+        memory = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+def _init_worker(specs: dict, shapes: dict):
+    '''Reconstruit les matrices du moteur sur la mémoire partagée'''
+    global _worker_engine
+    arrays = {}
+    for key, (name, dtype, shape) in specs.items():
+        memory = _attach(name)
+        _worker_memories.append(memory)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+    _worker_engine = ScoringEngine.__new__(ScoringEngine)
+    _worker_engine.inventory_ids = arrays['inventory_ids']
+    for matrix in ('color', 'no_color'):
+        setattr(
+            _worker_engine, f'required_{matrix}',
+            sparse.csr_matrix(
+                (arrays[f'{matrix}_data'], arrays[f'{matrix}_indices'],
+                 arrays[f'{matrix}_indptr']),
+                shape=shapes[matrix],
+                copy=False))
+
+
+def _best_shard(inventory_ids, encoded: tuple, k: int) -> pd.DataFrame:
+    return _worker_engine.best_encoded(inventory_ids, encoded, k)
+
+
+class ParallelScorer:
+    '''
+    Calcul des scores réparti sur un pool de processus, pour les très
+    grandes listes de pièces qui rendent la plupart du catalogue candidat.
+
+    Les matrices du moteur sont copiées une seule fois en mémoire partagée :
+    chaque processus les relit à son démarrage, et une tâche ne transporte
+    que sa tranche d'inventory_id et les pièces encodées de l'utilisateur.
+    Chaque tranche renvoie ses k meilleurs sets, fusionnés ensuite.
+    '''
+
+    def __init__(self,
+                 engine: ScoringEngine,
+                 processes: int = None,
+                 min_candidates: int = 5000):
+        '''
+        processes : nombre de processus (par défaut, le nombre de coeurs)
+        min_candidates : en dessous de ce nombre de sets candidats, le calcul
+            reste dans le processus courant
+        '''
+        self.engine = engine
+        self.processes = processes or os.cpu_count()
+        self.min_candidates = min_candidates
+
+        self._memories = []
+        specs = {}
+        for key, array in _engine_arrays(engine).items():
+            memory = shared_memory.SharedMemory(create=True,
+                                                size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=memory.buf)[:] = array
+            self._memories.append(memory)
+            specs[key] = (memory.name, array.dtype.str, array.shape)
+        shapes = {
+            'color': engine.required_color.shape,
+            'no_color': engine.required_no_color.shape,
+        }
+
+        self._pool = ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(specs, shapes))
+
+    def best(self, inventory_ids, available_qty: dict,
+             available_qty_no_color: dict, k: int) -> np.ndarray:
+        '''
+        Renvoie les inventory_id (triés) figurant parmi les k meilleurs d'au
+        moins un des deux classements (avec ou sans couleur).
+        '''
+        inventory_ids = np.asarray(inventory_ids)
+        encoded = self.engine.encode(available_qty, available_qty_no_color)
+
+        if len(inventory_ids) < self.min_candidates:
+            best = self.engine.best_encoded(inventory_ids, encoded, k)
+            return best['inventory_id'].to_numpy()
+
+        shards = [
+            shard for shard in np.array_split(inventory_ids, self.processes)
+            if len(shard)
+        ]
+        try:
+            futures = [
+                self._pool.submit(_best_shard, shard, encoded, k)
+                for shard in shards
+            ]
+        except RuntimeError:
+            # pool fermé (catalogue remplacé entre temps) : calcul local
+            best = self.engine.best_encoded(inventory_ids, encoded, k)
+            return best['inventory_id'].to_numpy()
+
+        # les tranches sont dans l'ordre des inventory_id : les égalités sont
+        # départagées comme par un calcul en un seul bloc
+        merged = pd.concat([future.result() for future in futures],
+                           ignore_index=True)
+        best = np.union1d(top_k(merged['percent_no_colour'], k),
+                          top_k(merged['percent_colour_match'], k))
+        return merged['inventory_id'].to_numpy()[best]
+
+    def close(self):
+        '''Arrête le pool (après les tâches en cours) et libère la mémoire'''
+        self._pool.shutdown(wait=True)
+        for memory in self._memories:
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,168 @@
+import os
+import json
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+def build_part_colors(inventories: pd.DataFrame,
+                      inventory_parts: pd.DataFrame,
+                      elements: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Construit la table des couleurs existantes de chaque pièce, équivalent
+    hors ligne de l'appel /lego/parts/{part_num}/colors/ de l'API.
+
+    INPUT :
+        les tables inventories, inventory_parts et elements, dont les
+        part_num partagent le même vocabulaire.
+
+    OUTPUT :
+        une dataframe (part_num, color_id, num_sets, num_set_parts, elements)
+        triée par part_num : nombre de sets contenant la pièce dans cette
+        couleur, nombre total d'exemplaires dans ces sets, et identifiants
+        des éléments LEGO correspondants (séparés par ', ').
+    '''
+    parts = inventory_parts[inventory_parts['is_spare'] == False].merge(
+        inventories[['id', 'set_num']], left_on='inventory_id', right_on='id')
+    in_sets = parts.groupby(['part_num', 'color_id'], observed=True).agg(
+        num_sets=('set_num', 'nunique'),
+        num_set_parts=('quantity', 'sum')).reset_index()
+    element_ids = elements.groupby(
+        ['part_num', 'color_id'],
+        observed=True)['element_id'].agg(', '.join).rename('elements')
+
+    part_colors = in_sets.merge(element_ids.reset_index(),
+                                on=['part_num', 'color_id'],
+                                how='outer')
+    part_colors[['num_sets', 'num_set_parts'
+                 ]] = part_colors[['num_sets',
+                                   'num_set_parts']].fillna(0).astype('int32')
+    part_colors['elements'] = part_colors['elements'].fillna('')
+    return part_colors.sort_values(['part_num', 'color_id'],
+                                   ignore_index=True)
+
+
+def _load_json(path: str, default):
+    '''Contenu d'un fichier JSON, default s'il n'existe pas'''
+    if path is None or not os.path.isfile(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_json(path: str, content):
+    '''
+    Ecrit un fichier JSON sous un nom temporaire unique puis le renomme :
+    plusieurs processus peuvent écrire le même fichier.
+    '''
+    if path is None:
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+class PartIdIndex:
+    '''
+    Correspondance entre identifiants BrickLink (renvoyés par Brickognize) et
+    Rebrickable, et couleurs de chaque pièce, sans appel à l'API.
+
+    Les dumps Rebrickable ne contiennent pas les identifiants externes :
+    l'index n'est pas une source de vérité, il mémorise les réponses de
+    l'API (cf. learn). Rebrickable reprend la numérotation BrickLink pour la
+    très grande majorité des pièces, mais une même chaîne peut désigner deux
+    pièces différentes : un identifiant BrickLink égal à un part_num du
+    catalogue n'est donc qu'une supposition, qui reste une absence (None,
+    l'appelant interroge alors l'API) tant que l'API ne l'a pas confirmée.
+    Les correspondances confirmées sont conservées dans overrides_path
+    (celles qui diffèrent de l'identité) et confirmed_path (les identités),
+    communs à toutes les versions du catalogue. Les couleurs (cf. colors)
+    sont, elles, lues dans les dumps.
+    '''
+
+    def __init__(self,
+                 part_codes: dict,
+                 part_colors: pd.DataFrame,
+                 colors: pd.DataFrame,
+                 overrides_path: str = None,
+                 confirmed_path: str = None):
+        '''
+        part_codes : part_num -> code du vocabulaire du catalogue
+        part_colors : cf. build_part_colors, avec les part_num en codes
+        colors : la table colors (id, name)
+        '''
+        self.part_codes = part_codes
+        self.part_colors = part_colors
+        self.color_names = dict(zip(colors['id'], colors['name']))
+        # bornes [début, fin[ des lignes de chaque code de pièce
+        self._bounds = np.searchsorted(part_colors['part_num'].to_numpy(),
+                                       np.arange(len(part_codes) + 1))
+        self.overrides_path = overrides_path
+        self.confirmed_path = confirmed_path
+        self._lock = threading.Lock()
+        self._overrides = _load_json(overrides_path, {})
+        # identifiants BrickLink dont l'API a confirmé qu'ils sont aussi le
+        # part_num Rebrickable
+        self._confirmed = set(_load_json(confirmed_path, []))
+        self._reverse = {
+            part_num: bricklink_id
+            for bricklink_id, part_num in self._overrides.items()
+        }
+
+    def rebrickable_id(self, bricklink_id: str):
+        '''part_num Rebrickable d'un identifiant BrickLink, ou None si inconnu'''
+        part_num = self._overrides.get(bricklink_id)
+        if part_num is not None:
+            return part_num
+        return bricklink_id if bricklink_id in self._confirmed else None
+
+    def bricklink_id(self, part_num: str):
+        '''Identifiant BrickLink d'un part_num Rebrickable, ou None si inconnu'''
+        bricklink_id = self._reverse.get(part_num)
+        if bricklink_id is not None:
+            return bricklink_id
+        return part_num if part_num in self._confirmed else None
+
+    def learn(self, bricklink_id: str, part_num: str):
+        '''
+        Enregistre une correspondance renvoyée par l'API : les lookups
+        suivants de bricklink_id n'appellent plus l'API.
+        '''
+        if part_num is None:
+            return
+        with self._lock:
+            if part_num == bricklink_id:
+                if bricklink_id in self._confirmed:
+                    return
+                self._confirmed.add(bricklink_id)
+                _save_json(self.confirmed_path, sorted(self._confirmed))
+            else:
+                if self._overrides.get(bricklink_id) == part_num:
+                    return
+                self._overrides[bricklink_id] = part_num
+                self._reverse[part_num] = bricklink_id
+                _save_json(self.overrides_path, self._overrides)
+
+    def colors(self, part_num: str) -> pd.DataFrame:
+        '''
+        Couleurs existantes d'une pièce Rebrickable, aux colonnes de
+        part_colors (sans bricklink_id ni part_img_url, absents des dumps).
+        Une dataframe vide si la pièce est inconnue.
+        '''
+        code = self.part_codes.get(part_num)
+        if code is None:
+            return pd.DataFrame()
+        rows = self.part_colors.iloc[self._bounds[code]:self._bounds[code +
+                                                                     1]]
+        return pd.DataFrame({
+            'rebrickable_id': part_num,
+            'color_id': rows['color_id'].to_numpy(),
+            'color_name': rows['color_id'].map(self.color_names).to_numpy(),
+            'num_sets': rows['num_sets'].to_numpy(),
+            'num_set_parts': rows['num_set_parts'].to_numpy(),
+            'elements': rows['elements'].to_numpy(),
+        })
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# profondeur maximale d'imbrication des inventaires (set -> sous-set ->
+# minifig...), qui protège aussi d'un éventuel cycle dans les données
+MAX_NESTING_DEPTH = 8
+
+
+def flatten_requirements(inventories: pd.DataFrame,
+                         inventory_parts: pd.DataFrame,
+                         inventory_minifigs: pd.DataFrame,
+                         inventory_sets: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Construit la table des pièces nécessaires à chaque inventaire, en
+    incluant les pièces des minifigs et des sous-sets qu'il contient,
+    multipliées par leur nombre d'exemplaires.
+
+    Un minifig ou un sous-set (fig_num / set_num) est développé avec son
+    propre inventaire de plus petite version. Le développement est fait
+    niveau par niveau : un sous-set contenant lui-même des minifigs est donc
+    entièrement développé.
+
+    INPUT :
+        les tables inventories, inventory_parts, inventory_minifigs et
+        inventory_sets. Les colonnes set_num de inventories et
+        inventory_sets, et fig_num de inventory_minifigs, doivent partager le
+        même vocabulaire (mêmes codes ou mêmes chaînes).
+
+    OUTPUT :
+        une dataframe (inventory_id, part_num, color_id, quantity) des pièces
+        hors spare, avec une ligne par pièce directe ou imbriquée
+    '''
+    parts = inventory_parts.loc[inventory_parts['is_spare'] == False, [
+        'inventory_id', 'part_num', 'color_id', 'quantity'
+    ]]
+
+    # inventaire de référence de chaque set_num / fig_num
+    first_inventory = inventories.sort_values('version').drop_duplicates(
+        'set_num').set_index('set_num')['id']
+
+    # arcs inventaire parent -> inventaire imbriqué, avec multiplicité
+    nested = pd.concat([
+        inventory_minifigs.rename(columns={'fig_num': 'set_num'}),
+        inventory_sets
+    ])[['inventory_id', 'set_num', 'quantity']]
+    nested['child_id'] = nested['set_num'].map(first_inventory)
+    edges = nested.dropna(subset=['child_id']).astype({
+        'child_id': np.int64,
+        'quantity': np.int64
+    })[['inventory_id', 'child_id', 'quantity']]
+
+    flattened = [parts]
+    level = edges
+    for _ in range(MAX_NESTING_DEPTH):
+        if level.empty:
+            break
+        # pièces des inventaires imbriqués, rattachées au parent
+        expanded = level.merge(parts,
+                               left_on='child_id',
+                               right_on='inventory_id',
+                               suffixes=('', '_child'))
+        expanded['quantity'] = expanded['quantity'] * expanded[
+            'quantity_child']
+        flattened.append(expanded[[
+            'inventory_id', 'part_num', 'color_id', 'quantity'
+        ]])
+        # niveau suivant : ce que contiennent les inventaires imbriqués
+        level = level.merge(edges,
+                            left_on='child_id',
+                            right_on='inventory_id',
+                            suffixes=('', '_child'))
+        level = pd.DataFrame({
+            'inventory_id': level['inventory_id'],
+            'child_id': level['child_id_child'],
+            'quantity': level['quantity'] * level['quantity_child'],
+        })
+
+    requirements = pd.concat(flattened, ignore_index=True)
+    return requirements.astype({
+        'inventory_id': parts['inventory_id'].dtype,
+        'color_id': parts['color_id'].dtype,
+        'quantity': np.int32,
+    })
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from legolas.completion.index import PartIndex
+
+
+def top_k(values, k: int) -> np.ndarray:
+    '''
+    Positions des k plus grandes valeurs, triées par valeur décroissante (à
+    égalité, la première position l'emporte), par sélection partielle
+    plutôt que par un tri complet.
+    '''
+    values = np.asarray(values)
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k < len(values):
+        kth = np.partition(values, len(values) - k)[len(values) - k]
+        above = np.flatnonzero(values > kth)
+        ties = np.flatnonzero(values == kth)[:k - len(above)]
+        positions = np.sort(np.concatenate([above, ties]))
+    else:
+        positions = np.arange(len(values))
+    return positions[np.argsort(-values[positions], kind='stable')]
+
+
+class ScoringEngine:
+    '''
+    Moteur de calcul des pourcentages de pièces disponibles pour tous les sets
+    candidats à la fois.
+
+    Les besoins des sets sont stockés dans deux matrices creuses construites
+    une seule fois par chargement du catalogue :
+        - inventaire x (part_num, color_id) : quantités requises en couleur
+        - inventaire x part_num : quantités requises sans tenir compte des
+            couleurs
+    Les pièces de l'utilisateur deviennent un vecteur sur les mêmes colonnes.
+    Pour chaque set, la quantité disponible d'une pièce est
+    min(requis, disponible), ce qui se calcule directement sur les valeurs
+    non nulles de la matrice.
+    '''
+
+    def __init__(self, part_index: PartIndex):
+        '''
+        part_index : l'index des pièces (hors spare) du catalogue, dont on
+            reprend les codes de pièces comme colonnes sans couleur.
+        '''
+        parts = part_index.parts
+        self.part_codes = part_index.part_codes
+        part_codes = parts['part_num'].to_numpy().astype(np.int64)
+        color_ids = parts['color_id'].to_numpy().astype(np.int64)
+        quantities = parts['quantity'].to_numpy().astype(np.int32)
+
+        self.inventory_ids, rows = np.unique(
+            parts['inventory_id'].to_numpy(), return_inverse=True)
+
+        # colonnes avec couleur : couples (code pièce, color_id) triés
+        self.pair_keys, pair_codes = np.unique(
+            self._pair_key(part_codes, color_ids), return_inverse=True)
+
+        # les doublons (même pièce sur plusieurs lignes) sont sommés
+        shape = (len(self.inventory_ids), len(self.pair_keys))
+        self.required_color = sparse.csr_matrix(
+            (quantities, (rows, pair_codes)), shape=shape)
+        shape = (len(self.inventory_ids), len(part_index.part_nums))
+        self.required_no_color = sparse.csr_matrix(
+            (quantities, (rows, part_codes)), shape=shape)
+
+    @staticmethod
+    def _pair_key(part_codes, color_ids):
+        '''Clé entière unique d'un couple (code pièce, color_id)'''
+        return np.asarray(part_codes, dtype=np.int64) * 65536 + np.asarray(
+            color_ids, dtype=np.int64) + 1
+
+    def encode(self, available_qty: dict,
+               available_qty_no_color: dict) -> tuple:
+        '''
+        Encode les pièces disponibles en vecteurs creux (colonnes, quantités)
+        sur les colonnes des matrices, sans couleur puis avec couleur. Les
+        pièces absentes du catalogue sont ignorées.
+        '''
+        known = [part_num for part_num in available_qty_no_color
+                 if part_num in self.part_codes]
+        part_columns = np.array([self.part_codes[part_num] for part_num in known],
+                                dtype=np.int64)
+        part_quantities = np.array(
+            [available_qty_no_color[part_num] for part_num in known],
+            dtype=np.int64)
+
+        pairs = [(self.part_codes[part_num], color_id, quantity)
+                 for (part_num, color_id), quantity in available_qty.items()
+                 if part_num in self.part_codes]
+        pair_columns, pair_quantities = (np.array([], dtype=np.int64), ) * 2
+        if pairs and len(self.pair_keys):
+            codes, color_ids, quantities = zip(*pairs)
+            keys = self._pair_key(codes, color_ids)
+            columns = np.minimum(np.searchsorted(self.pair_keys, keys),
+                                 len(self.pair_keys) - 1)
+            found = self.pair_keys[columns] == keys
+            pair_columns = columns[found]
+            pair_quantities = np.asarray(quantities, dtype=np.int64)[found]
+
+        return part_columns, part_quantities, pair_columns, pair_quantities
+
+    @staticmethod
+    def _percent_matched(required: sparse.csr_matrix,
+                         available: np.ndarray) -> np.ndarray:
+        '''Pourcentage (arrondi à 2 décimales) des pièces requises disponibles'''
+        matched = required.copy()
+        matched.data = np.minimum(matched.data, available[matched.indices])
+        total = np.asarray(required.sum(axis=1)).ravel()
+        matched_total = np.asarray(matched.sum(axis=1)).ravel()
+        percent = np.divide(matched_total * 100,
+                            total,
+                            out=np.zeros(len(total)),
+                            where=total > 0)
+        return np.round(percent, 2)
+
+    def count_part_num(self, inventory_ids) -> np.ndarray:
+        '''Nombre de part_num différents de chaque inventaire'''
+        rows = np.searchsorted(self.inventory_ids, np.asarray(inventory_ids))
+        return np.diff(self.required_no_color.indptr)[rows]
+
+    def score(self, inventory_ids, available_qty: dict,
+              available_qty_no_color: dict) -> pd.DataFrame:
+        '''
+        Calcule les pourcentages de pièces disponibles pour chaque inventaire
+        de inventory_ids, que l'on tienne compte ou non des couleurs.
+
+        INPUT :
+            inventory_ids : les inventaires à évaluer
+            les dictionnaires des pièces disponibles si on tient compte ou non
+            des couleurs (cf. available_part_num_dict).
+
+        OUTPUT :
+            une dataframe avec une ligne par inventaire et les colonnes
+            'inventory_id', 'percent_no_colour' et 'percent_colour_match'
+        '''
+        return self.score_encoded(
+            inventory_ids, self.encode(available_qty, available_qty_no_color))
+
+    def score_encoded(self, inventory_ids, encoded: tuple) -> pd.DataFrame:
+        '''Comme score, avec des pièces disponibles déjà encodées (cf. encode)'''
+        inventory_ids = np.asarray(inventory_ids)
+        rows = np.searchsorted(self.inventory_ids, inventory_ids)
+
+        part_columns, part_quantities, pair_columns, pair_quantities = encoded
+        available_no_color = np.bincount(
+            part_columns,
+            weights=part_quantities,
+            minlength=self.required_no_color.shape[1]).astype(np.int64)
+        available_color = np.bincount(
+            pair_columns,
+            weights=pair_quantities,
+            minlength=self.required_color.shape[1]).astype(np.int64)
+
+        return pd.DataFrame({
+            'inventory_id':
+            inventory_ids,
+            'percent_no_colour':
+            self._percent_matched(self.required_no_color[rows],
+                                  available_no_color),
+            'percent_colour_match':
+            self._percent_matched(self.required_color[rows],
+                                  available_color),
+        })
+
+    def best_encoded(self, inventory_ids, encoded: tuple,
+                     k: int) -> pd.DataFrame:
+        '''
+        Scores des inventaires figurant parmi les k meilleurs d'au moins un
+        des deux classements (avec ou sans couleur), triés par inventory_id.
+        '''
+        scores = self.score_encoded(inventory_ids, encoded)
+        best = np.union1d(top_k(scores['percent_no_colour'], k),
+                          top_k(scores['percent_colour_match'], k))
+        return scores.iloc[best]
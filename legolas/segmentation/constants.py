@@ -53,3 +53,22 @@ SAM_CONFIG_2 = {
     "point_grids": SAM_DEFAULT_PARAMS["point_grids"],
     "min_mask_region_area": 20
 }
+
+# Filtering of SAM masks before classification (see filter_masks): bbox area
+# bounds relative to the image, IoU above which two bboxes are merged, and
+# share of a mask inside a larger one above which it is dropped
+MASK_FILTER_CONFIG = {
+    "min_area_ratio": 0.0005,
+    "max_area_ratio": 0.5,
+    "duplicate_iou_thresh": 0.85,
+    "containment_thresh": 0.85
+}
+
+# number of images per forward pass of the SAM image encoder (batch /predict),
+# per device. Batches pay off on GPU; on CPU each image of a batch needs ~2 Gb
+# of activations (ViT-B) for no real speedup
+SAM_ENCODER_BATCH_SIZE = {"cuda": 4, "cpu": 1}
+
+# number of SAM image embeddings kept in memory (~4 Mb each), so that
+# re-running or re-segmenting the same photo skips the image encoder
+SAM_EMBEDDING_CACHE_SIZE = 16
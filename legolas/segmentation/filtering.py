@@ -0,0 +1,104 @@
+import numpy as np
+
+from legolas.segmentation.constants import MASK_FILTER_CONFIG
+
+
+def _box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU of an XYXY box with each of several XYXY boxes"""
+    width = np.clip(np.minimum(box[2], boxes[:, 2]) -
+                    np.maximum(box[0], boxes[:, 0]), 0, None)
+    height = np.clip(np.minimum(box[3], boxes[:, 3]) -
+                     np.maximum(box[1], boxes[:, 1]), 0, None)
+    intersection = width * height
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = (box[2] - box[0]) * (box[3] - box[1]) + areas - intersection
+    return intersection / np.maximum(union, 1)
+
+
+def _region(pred: dict, box: np.ndarray) -> np.ndarray:
+    """Pixels of a prediction inside an XYXY window: its mask if any, else its
+    bbox"""
+    x0, y0, x1, y1 = box
+    if "segmentation" in pred:
+        return pred["segmentation"][y0:y1, x0:x1]
+    left, upper, w, h = np.round(pred["bbox"]).astype(int)
+    region = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    region[max(upper - y0, 0):max(upper + h - y0, 0),
+           max(left - x0, 0):max(left + w - x0, 0)] = True
+    return region
+
+
+def _merge(pred: dict, other: dict) -> dict:
+    """Union of two near-duplicate predictions, keeping the best scored one"""
+    if other.get("predicted_iou", 0) > pred.get("predicted_iou", 0):
+        pred, other = other, pred
+    merged = dict(pred)
+    (x0, y0, w0, h0), (x1, y1, w1, h1) = pred["bbox"], other["bbox"]
+    left, upper = min(x0, x1), min(y0, y1)
+    merged["bbox"] = [
+        left, upper,
+        max(x0 + w0, x1 + w1) - left,
+        max(y0 + h0, y1 + h1) - upper
+    ]
+    if "segmentation" in pred and "segmentation" in other:
+        merged["segmentation"] = pred["segmentation"] | other["segmentation"]
+        merged["area"] = int(merged["segmentation"].sum())
+    return merged
+
+
+def filter_masks(preds: list, image_shape: tuple,
+                 config: dict = MASK_FILTER_CONFIG,
+                 check_size: bool = True) -> list:
+    """Clean SAM predictions (masks with an XYWH "bbox") before classification:
+    1. drop parts whose bbox is implausibly small or large for the image
+       (only if check_size: box-prompted masks come from detected parts,
+       which may fill a close-up photo)
+    2. merge near-duplicates (bbox IoU above duplicate_iou_thresh)
+    3. drop parts mostly contained in a larger kept one (studs, sub-regions
+       of a brick...): containment_thresh of their pixels inside it
+
+    Returns the kept predictions, largest first.
+    """
+    if check_size:
+        image_area = image_shape[0] * image_shape[1]
+        preds = [
+            pred for pred in preds
+            if config["min_area_ratio"] <= pred["bbox"][2] *
+            pred["bbox"][3] / image_area <= config["max_area_ratio"]
+        ]
+    else:
+        preds = list(preds)
+    preds.sort(key=lambda pred: pred["bbox"][2] * pred["bbox"][3],
+               reverse=True)
+
+    def xyxy(pred):
+        left, upper, w, h = pred["bbox"]
+        return np.round([left, upper, left + w, upper + h]).astype(int)
+
+    kept = []
+    for pred in preds:
+        box = xyxy(pred)
+        if kept:
+            boxes = np.array([xyxy(other) for other in kept])
+            ious = _box_iou(box, boxes)
+            duplicate = int(np.argmax(ious))
+            if ious[duplicate] >= config["duplicate_iou_thresh"]:
+                kept[duplicate] = _merge(kept[duplicate], pred)
+                continue
+
+            area = _region(pred, box).sum()
+            contained = False
+            for other, other_box in zip(kept, boxes):
+                window = np.concatenate([np.maximum(box[:2], other_box[:2]),
+                                         np.minimum(box[2:], other_box[2:])])
+                if (window[:2] >= window[2:]).any():
+                    continue
+                inside = (_region(pred, window) & _region(other, window)).sum()
+                if inside >= config["containment_thresh"] * max(area, 1):
+                    contained = True
+                    break
+            if contained:
+                continue
+        kept.append(pred)
+
+    return kept
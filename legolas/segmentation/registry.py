@@ -1,8 +1,9 @@
 from pathlib import Path
 import requests
 
+import numpy as np
 from roboflow import Roboflow
-from segment_anything import sam_model_registry
+from segment_anything import sam_model_registry, SamPredictor
 import torch
 
 def load_model_RF(api_key: str, project_id: str, version: int):
@@ -15,10 +16,20 @@ def load_model_RF(api_key: str, project_id: str, version: int):
     return model
 
 
-def load_SAM():
+def load_SAM(quantize: bool = False, num_threads: int = None,
+             self_check: bool = False, backend: str = "torch"):
     """Load the lightest Segment-anything model from META
     Download the Vit-B SAM model checkpoint if not in /tmp/ (~350 Mb). See
     https://github.com/facebookresearch/segment-anything?tab=readme-ov-file#model-checkpoints
+
+    CPU-only options:
+    - backend: "torch", or "onnx" to run the image encoder and mask decoder
+      on onnxruntime (exported once to models/, see use_onnx)
+    - quantize: dynamic int8 quantization of the linear layers of the image
+      encoder (most of SAM's compute and weights)
+    - num_threads: number of intra-op threads used by torch / onnxruntime
+    - self_check: report the agreement of the optimized and fp32 torch masks
+      on a test image
     """
     print("initializing SAM model...")
     weights_path = "models/sam_vit_b_01ec64.pth"  # trained weights
@@ -49,5 +60,76 @@ def load_SAM():
     print(f"SAM: GPU will {'' if device=='cuda' else 'NOT '}be used")
     model = sam_model_registry[model_type](checkpoint=weights_path)
     model.to(device=device)
+    model.eval()
+
+    if device == "cpu" and num_threads:
+        torch.set_num_threads(num_threads)
+        print(f"SAM: {num_threads} CPU threads")
+
+    if device == "cpu" and (quantize or backend == "onnx"):
+        reference = (model.image_encoder, model.mask_decoder)
+        if backend == "onnx":
+            from legolas.segmentation.sam_onnx import use_onnx
+            use_onnx(model, weights_path, quantize, num_threads)
+        else:
+            model.image_encoder = torch.ao.quantization.quantize_dynamic(
+                model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+            print("SAM: image encoder quantized to int8")
+        if self_check:
+            agreement = _mask_agreement(model, *reference)
+            print(f"SAM: mask agreement with fp32 torch (mean IoU) = {agreement:.3f}")
 
     return model
+
+
+def self_check_image():
+    """Test image for the SAM self-check, drawn rather than stored: a few
+    bricks (with studs) of different colors and sizes on a plain background.
+    Returns the RGB image and the [x0, y0, x1, y1] box of each brick.
+    """
+    image = np.full((384, 512, 3), 225, dtype=np.uint8)
+    bricks = [((40, 50, 200, 130), (201, 26, 9)),
+              ((260, 40, 340, 200), (0, 85, 191)),
+              ((380, 220, 480, 340), (242, 205, 55)),
+              ((60, 220, 300, 300), (35, 120, 65)),
+              ((200, 320, 260, 370), (27, 42, 52))]
+    yy, xx = np.mgrid[:image.shape[0], :image.shape[1]]
+    for (x0, y0, x1, y1), color in bricks:
+        image[y0:y1, x0:x1] = color
+        # studs, slightly lighter, every 20 px
+        for cy in range(y0 + 10, y1 - 5, 20):
+            for cx in range(x0 + 10, x1 - 5, 20):
+                stud = (xx - cx) ** 2 + (yy - cy) ** 2 < 36
+                image[stud] = np.minimum(np.array(color) + 30, 255)
+    return image, [box for box, _ in bricks]
+
+
+@torch.inference_mode()
+def _mask_agreement(model, image_encoder, mask_decoder) -> float:
+    """Mean IoU between the masks of the test image bricks (one box prompt
+    each) computed by the model and with the reference image_encoder and
+    mask_decoder"""
+    image, boxes = self_check_image()
+    masks = []
+    modules = (model.image_encoder, model.mask_decoder)
+    try:
+        for encoder, decoder in (modules, (image_encoder, mask_decoder)):
+            model.image_encoder, model.mask_decoder = encoder, decoder
+            predictor = SamPredictor(model)
+            predictor.set_image(image)
+            box_masks, _, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=predictor.transform.apply_boxes_torch(
+                    torch.as_tensor(boxes, dtype=torch.float,
+                                    device=predictor.device),
+                    image.shape[:2]),
+                multimask_output=False)
+            masks.append(box_masks[:, 0].cpu().numpy())
+    finally:
+        model.image_encoder, model.mask_decoder = modules
+
+    intersection = (masks[0] & masks[1]).sum(axis=(1, 2))
+    union = (masks[0] | masks[1]).sum(axis=(1, 2))
+    iou = np.where(union > 0, intersection / np.maximum(union, 1), 1)
+    return float(iou.mean())
@@ -0,0 +1,219 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+
+from legolas.segmentation.constants import (
+    SAM_CONFIG_1,
+    SAM_ENCODER_BATCH_SIZE,
+    SAM_EMBEDDING_CACHE_SIZE
+)
+
+
+def image_key(image: np.ndarray) -> str:
+    """Content key of an image array, used to find its precomputed embedding"""
+    digest = hashlib.blake2b(np.ascontiguousarray(image).data,
+                             digest_size=16).hexdigest()
+    return f"{digest}-{'x'.join(map(str, image.shape))}"
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of SAM image embeddings, keyed by image_key.
+    An embedding of ViT-B takes ~4 Mb, against seconds of encoder on CPU.
+    """
+
+    def __init__(self, max_size: int = SAM_EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self._embeddings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            embedding = self._embeddings.get(key)
+            if embedding is not None:
+                self._embeddings.move_to_end(key)
+            return embedding
+
+    def put(self, key: str, embedding):
+        with self._lock:
+            self._embeddings[key] = embedding
+            self._embeddings.move_to_end(key)
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+
+
+class PrecomputedSamPredictor(SamPredictor):
+    """SamPredictor that reuses image embeddings computed beforehand (see
+    encode_images) instead of running the image encoder again. Images without
+    a precomputed embedding are encoded as usual.
+    """
+
+    def __init__(self, sam_model, embeddings: dict = None):
+        super().__init__(sam_model)
+        self.embeddings = embeddings or {}  # image_key -> embedding
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB"):
+        embedding = self.embeddings.get(image_key(image))
+        if embedding is None or image_format != self.model.image_format:
+            super().set_image(image, image_format)
+            return
+        self.set_embedding(embedding)
+
+    def set_embedding(self, embedding: tuple):
+        """Use an embedding returned by encode_images as the current image"""
+        self.reset_image()
+        self.features, self.original_size, self.input_size = embedding
+        self.is_image_set = True
+
+
+@torch.inference_mode()
+def encode_images(model, images: list, batch_size: int = None) -> list:
+    """Run the SAM image encoder on several RGB images, batch_size images per
+    forward pass (by default, SAM_ENCODER_BATCH_SIZE of the model device).
+    Images are resized and padded to the encoder input size, so images of
+    different sizes share a batch.
+
+    Returns one (features, original_size, input_size) embedding per image, as
+    set by SamPredictor.set_image.
+    """
+    batch_size = batch_size or SAM_ENCODER_BATCH_SIZE.get(model.device.type, 1)
+    predictor = SamPredictor(model)
+    embeddings = []
+    for start in range(0, len(images), batch_size):
+        batch, sizes = [], []
+        for image in images[start:start + batch_size]:
+            input_image = predictor.transform.apply_image(image)
+            input_image = torch.as_tensor(input_image, device=predictor.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()[None]
+            sizes.append((image.shape[:2], tuple(input_image.shape[-2:])))
+            batch.append(model.preprocess(input_image))
+        features = model.image_encoder(torch.cat(batch))
+        # cloned: a slice would keep the whole batch output alive in the cache
+        embeddings += [(features[i:i + 1].clone(), original_size, input_size)
+                       for i, (original_size, input_size) in enumerate(sizes)]
+    return embeddings
+
+
+def get_embeddings(model, images: list, cache: EmbeddingCache = None) -> list:
+    """Embeddings of several RGB images: those found in cache are reused, the
+    others are computed in batches (see encode_images) and added to it.
+    """
+    if cache is None:
+        return encode_images(model, images)
+    keys = [image_key(image) for image in images]
+    embeddings = [cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    for i, embedding in zip(missing,
+                            encode_images(model, [images[i] for i in missing])):
+        cache.put(keys[i], embedding)
+        embeddings[i] = embedding
+    return embeddings
+
+
+@torch.inference_mode()
+def generate_masks(model, images: list, config: dict = SAM_CONFIG_1,
+                   cache: EmbeddingCache = None) -> list:
+    """SamAutomaticMaskGenerator.generate over several RGB images, whose
+    embeddings are computed in batches beforehand (or found in cache).
+
+    Returns the list of masks of each image.
+    """
+    embeddings = get_embeddings(model, images, cache)
+    mask_generator = SamAutomaticMaskGenerator(model=model, **config)
+    mask_generator.predictor = PrecomputedSamPredictor(
+        model,
+        {image_key(image): embedding
+         for image, embedding in zip(images, embeddings)})
+    return [mask_generator.generate(image) for image in images]
+
+
+@torch.inference_mode()
+def segment_prompt(model, image: np.ndarray, points: list = None,
+                   labels: list = None, box: list = None,
+                   cache: EmbeddingCache = None) -> dict:
+    """Segment one part of an RGB image from point and/or box prompts. With
+    the image embedding in cache, only the mask decoder runs (milliseconds).
+
+    Arguments:
+      points: [[x, y], ...] point prompts, in pixels
+      labels: label of each point (1 = on the part, 0 = background)
+      box: [x0, y0, x1, y1] box prompt, in pixels
+
+    Returns the best mask, in the format of SamAutomaticMaskGenerator
+    ("segmentation", "bbox" in XYWH, "area", "predicted_iou"), or None if the
+    mask is empty.
+    """
+    predictor = PrecomputedSamPredictor(model)
+    predictor.set_embedding(get_embeddings(model, [image], cache)[0])
+
+    point_coords = np.array(points, dtype=np.float32) if points else None
+    point_labels = None
+    if points:
+        point_labels = np.array(labels if labels else [1] * len(points))
+    masks, scores, _ = predictor.predict(
+        point_coords=point_coords,
+        point_labels=point_labels,
+        box=np.array(box, dtype=np.float32) if box else None,
+        # a single point is ambiguous (stud, brick, pile...): keep the best
+        # of the 3 proposed masks
+        multimask_output=box is None and len(points or []) == 1)
+
+    best = int(np.argmax(scores))
+    return _mask_to_pred(masks[best], scores[best])
+
+
+def _mask_to_pred(mask: np.ndarray, score: float) -> dict:
+    """Mask in the format of SamAutomaticMaskGenerator, None if empty"""
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return None
+    return {
+        "segmentation": mask,
+        "bbox": [int(xs.min()), int(ys.min()),
+                 int(xs.max() - xs.min()), int(ys.max() - ys.min())],
+        "area": int(mask.sum()),
+        "predicted_iou": float(score),
+    }
+
+
+@torch.inference_mode()
+def segment_boxes(model, image: np.ndarray, boxes: list,
+                  cache: EmbeddingCache = None,
+                  batch_size: int = SAM_CONFIG_1["points_per_batch"]) -> list:
+    """Refine detector boxes into SAM masks: one box prompt per part, run in
+    batches through the mask decoder after a single image encode, instead of
+    the thousands of prompts of the automatic point grid.
+
+    Arguments:
+      boxes: [[x0, y0, x1, y1], ...] boxes, in pixels
+
+    Returns one mask per box (see segment_prompt), in the same order. A box
+    whose mask is empty is kept as is.
+    """
+    if not boxes:
+        return []
+    predictor = PrecomputedSamPredictor(model)
+    predictor.set_embedding(get_embeddings(model, [image], cache)[0])
+
+    preds = []
+    for start in range(0, len(boxes), batch_size):
+        batch = torch.as_tensor(boxes[start:start + batch_size],
+                                dtype=torch.float,
+                                device=predictor.device)
+        masks, scores, _ = predictor.predict_torch(
+            point_coords=None,
+            point_labels=None,
+            boxes=predictor.transform.apply_boxes_torch(batch,
+                                                        image.shape[:2]),
+            multimask_output=False)
+        for box, mask, score in zip(batch.tolist(), masks[:, 0].cpu().numpy(),
+                                    scores[:, 0].cpu().numpy()):
+            pred = _mask_to_pred(mask, score)
+            if pred is None:
+                x0, y0, x1, y1 = map(int, box)
+                pred = {"bbox": [x0, y0, x1 - x0, y1 - y0]}
+            preds.append(pred)
+    return preds
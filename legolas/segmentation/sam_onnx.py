@@ -0,0 +1,149 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+import onnxruntime
+
+ONNX_OPSET = 17
+
+
+class _MaskDecoderOutputs(torch.nn.Module):
+    """Mask decoder returning the masks and IoU predictions of all its mask
+    tokens: the multimask_output choice is a slice, done after the ONNX run"""
+
+    def __init__(self, mask_decoder):
+        super().__init__()
+        self.mask_decoder = mask_decoder
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings,
+                dense_prompt_embeddings):
+        return self.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            dense_prompt_embeddings=dense_prompt_embeddings)
+
+
+def export_onnx(model, encoder_path: Path, decoder_path: Path):
+    """Export the image encoder and the mask decoder of a SAM model to ONNX.
+    The encoder takes a batch of preprocessed images, the decoder a batch of
+    prompts of any number of points.
+    """
+    img_size = model.image_encoder.img_size
+    embedding_size = model.prompt_encoder.image_embedding_size
+    embedding_dim = model.prompt_encoder.embed_dim
+
+    with torch.inference_mode():
+        torch.onnx.export(model.image_encoder,
+                          (torch.zeros(1, 3, img_size, img_size), ),
+                          str(encoder_path),
+                          input_names=["image"],
+                          output_names=["image_embeddings"],
+                          dynamic_axes={
+                              "image": {0: "batch"},
+                              "image_embeddings": {0: "batch"}
+                          },
+                          opset_version=ONNX_OPSET,
+                          dynamo=False)
+
+        torch.onnx.export(
+            _MaskDecoderOutputs(model.mask_decoder),
+            (torch.zeros(1, embedding_dim, *embedding_size),
+             torch.zeros(1, embedding_dim, *embedding_size),
+             torch.zeros(2, 3, embedding_dim),
+             torch.zeros(2, embedding_dim, *embedding_size)),
+            str(decoder_path),
+            input_names=[
+                "image_embeddings", "image_pe", "sparse_prompt_embeddings",
+                "dense_prompt_embeddings"
+            ],
+            output_names=["masks", "iou_predictions"],
+            dynamic_axes={
+                "sparse_prompt_embeddings": {0: "prompts", 1: "points"},
+                "dense_prompt_embeddings": {0: "prompts"},
+                "masks": {0: "prompts"},
+                "iou_predictions": {0: "prompts"},
+            },
+            opset_version=ONNX_OPSET,
+            dynamo=False)
+
+
+class OnnxImageEncoder(torch.nn.Module):
+    """Drop-in replacement of Sam.image_encoder running on onnxruntime"""
+
+    def __init__(self, session, img_size: int):
+        super().__init__()
+        self.session = session
+        self.img_size = img_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        (embeddings, ) = self.session.run(
+            None, {"image": x.detach().cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(embeddings)
+
+
+class OnnxMaskDecoder(torch.nn.Module):
+    """Drop-in replacement of Sam.mask_decoder running on onnxruntime"""
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings,
+                dense_prompt_embeddings, multimask_output: bool):
+        masks, iou_predictions = self.session.run(
+            None, {
+                "image_embeddings": image_embeddings.cpu().numpy(),
+                "image_pe": image_pe.cpu().numpy(),
+                "sparse_prompt_embeddings":
+                sparse_prompt_embeddings.cpu().numpy(),
+                "dense_prompt_embeddings":
+                dense_prompt_embeddings.cpu().numpy(),
+            })
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        return (torch.from_numpy(masks[:, mask_slice]),
+                torch.from_numpy(iou_predictions[:, mask_slice]))
+
+
+def use_onnx(model, weights_path: str, quantize: bool = False,
+             num_threads: int = None):
+    """Run the image encoder and mask decoder of a (CPU) SAM model on
+    onnxruntime. They are exported once next to the weights and reused by
+    later starts; the prompt encoder and the pre/post-processing stay in
+    torch, so SamPredictor and SamAutomaticMaskGenerator work unchanged.
+
+    With quantize, the encoder weights are quantized to int8 by onnxruntime.
+    """
+    weights_path = Path(weights_path)
+    encoder_path = weights_path.with_suffix(".encoder.onnx")
+    decoder_path = weights_path.with_suffix(".decoder.onnx")
+    if not encoder_path.is_file() or not decoder_path.is_file():
+        print("  exporting SAM to ONNX...", end="", flush=True)
+        export_onnx(model, encoder_path, decoder_path)
+        print(" done!")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = weights_path.with_suffix(".encoder.int8.onnx")
+        if not int8_path.is_file():
+            quantize_dynamic(str(encoder_path),
+                             str(int8_path),
+                             weight_type=QuantType.QInt8)
+        encoder_path = int8_path
+
+    options = onnxruntime.SessionOptions()
+    # the encoder activations are large and used once per image: an arena
+    # would keep its peak allocation for the life of the process
+    options.enable_cpu_mem_arena = False
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    providers = ["CPUExecutionProvider"]
+    model.image_encoder = OnnxImageEncoder(
+        onnxruntime.InferenceSession(str(encoder_path), options,
+                                     providers=providers),
+        model.image_encoder.img_size)
+    model.mask_decoder = OnnxMaskDecoder(
+        onnxruntime.InferenceSession(str(decoder_path), options,
+                                     providers=providers))
+    print(f"SAM: ONNX Runtime backend ({encoder_path.name})")
+    return model
@@ -0,0 +1,67 @@
+"""Compare the SAM backends on CPU: image encoding and SAM_CONFIG_1 automatic
+mask generation, with the agreement of each backend's masks against fp32
+torch. Run from the repository root (needs models/sam_vit_b_01ec64.pth):
+
+    python -m scripts.benchmark_sam [image] [--threads N] [--runs N]
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from legolas.segmentation.constants import SAM_CONFIG_1
+from legolas.segmentation.registry import load_SAM, self_check_image
+from legolas.segmentation.sam import encode_images, generate_masks
+
+BACKENDS = {
+    "torch fp32": {},
+    "torch int8": {"quantize": True},
+    "onnx fp32": {"backend": "onnx"},
+    "onnx int8": {"backend": "onnx", "quantize": True},
+}
+
+
+def _union_iou(masks, reference) -> float:
+    """IoU of the union of the masks of two generations"""
+    union = np.any([m["segmentation"] for m in masks], axis=0)
+    union_ref = np.any([m["segmentation"] for m in reference], axis=0)
+    return float((union & union_ref).sum() / max((union | union_ref).sum(), 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", nargs="?", help="default: self-check image")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.image:
+        image = np.asarray(Image.open(args.image).convert("RGB"))
+    else:
+        image, _ = self_check_image()
+
+    reference = None
+    print(f"{'backend':<12} {'encode (s)':>11} {'generate (s)':>13} "
+          f"{'masks':>6} {'IoU vs fp32':>12}")
+    for name, options in BACKENDS.items():
+        model = load_SAM(num_threads=args.threads, **options)
+        encode_images(model, [image])  # warm-up
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            encode_images(model, [image])
+        encode = (time.perf_counter() - start) / args.runs
+
+        start = time.perf_counter()
+        masks = generate_masks(model, [image], SAM_CONFIG_1)[0]
+        generate = time.perf_counter() - start
+
+        if reference is None:
+            reference = masks
+        iou = _union_iou(masks, reference) if masks or reference else 1.0
+        print(f"{name:<12} {encode:>11.2f} {generate:>13.2f} "
+              f"{len(masks):>6} {iou:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -58,6 +58,7 @@ if uploaded_file:
                 "-": None,
                 "(Roboflow Lego Object Detection) Quick and dirty": "LOD",
                 "(Roboflow Lego Brick Detector) Quick and not so dirty": "LBD",
+                "(Lego Brick Detector + Segment Anything) Quick with tight crops": "LBD+SAM",
                 "(Meta Segment Anything Model) Slow but comprehensive (hopefully)": "SAM"
             }
             selected_label = st.selectbox("Choose a model for part detection:",